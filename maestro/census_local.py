@@ -3,7 +3,8 @@ import socket
 import os
 
 KNOWN_EXTENSIONS = ['.json', '.csv', '.parquet', '.zip']
-CHUNK_SIZE = 1024
+# Smallest read of the downloads, chunks grow from here on fast links
+CHUNK_SIZE = 64 * 1024
 census_id = socket.gethostname() 
 
 # development environment
@@ -31,3 +32,130 @@ log_dir = os.path.join (data_dir, 'logs')
 file_dir = os.path.join(data_dir, 'files')
 upload_dir = os.path.join(file_dir, 'uploads')
 log_file = os.path.join(log_dir, 'census.log')
+catalog_file = os.path.join(db_dir, 'census_catalog.duckdb')
+sync_dir = os.path.join(data_dir, 'sync')
+upload_tmp_dir = os.path.join(data_dir, 'upload_tmp')
+extractor_db_file = os.path.join(db_dir, 'extractor_jobs.sqlite')
+transfer_db_file = os.path.join(db_dir, 'transfer_jobs.sqlite')
+qcache_dir = os.path.join(data_dir, 'qcache')
+
+# DuckDB connection pool
+# Maximum number of databases kept open (LRU eviction above this)
+DUCK_POOL_MAX_OPEN = 16
+# Seconds an unused connection stays open
+DUCK_POOL_IDLE_TIMEOUT = 300
+
+# Server-side cursors (/sql/execute?fetchmany= and /sql/fetch)
+# Maximum number of open cursors (LRU eviction above this)
+CURSOR_MAX_OPEN = 64
+# Seconds a cursor is kept without a fetch
+CURSOR_TTL = 600
+# Estimated memory (bytes) of all cursors together
+CURSOR_MAX_MEMORY = 512 * 1024 * 1024
+# Rows per fetch when fetchmany is not specified
+CURSOR_FETCH_SIZE = 1000
+
+# Streaming SQL results (/sql/execute?stream=)
+# Rows fetched from DuckDB per chunk
+STREAM_BATCH_SIZE = 10000
+
+# Query result cache (/sql/execute?cache=true)
+# Memory for cached results (Arrow), least recently used are evicted above it
+QUERY_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Disk for results evicted from memory, kept in qcache_dir. 0 disables it
+QUERY_CACHE_SPILL_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Direct ingestion (/transfer/json with a table)
+# Records per Arrow batch inserted into the table
+INGEST_BATCH_SIZE = 10000
+
+# Resumable uploads (/uploads/sessions)
+# Uploads without activity for longer than this are dropped (seconds)
+UPLOAD_SESSION_TTL = 24 * 3600
+
+# Extractor (meltano run) scheduler
+# Runs at once, across every server process. One run at a time per target
+EXTRACTOR_MAX_RUNNING = 2
+# Runs taking longer are killed (seconds)
+EXTRACTOR_TIMEOUT = 6 * 3600
+# How often ended runs, timeouts and the queue are checked and runs sampled (seconds)
+EXTRACTOR_POLL_INTERVAL = 2
+# Most log bytes returned by one /extractor/<exec_id> call
+LOG_TAIL_MAX_BYTES = 4 * 1024 * 1024
+# How often the log is checked for new records in the SSE stream (seconds)
+LOG_TAIL_POLL_INTERVAL = 1
+
+# FileSet watcher, keeps fset up to date with files changed under file_dir
+FSET_WATCH = False
+# Use inotify on Linux, otherwise poll directory mtimes
+FSET_WATCH_INOTIFY = True
+# Seconds without changes before applying them
+FSET_WATCH_DEBOUNCE = 2
+# Seconds between polls (polling backend)
+FSET_WATCH_POLL_INTERVAL = 10
+# Seconds between catalog saves
+FSET_WATCH_CHECKPOINT_INTERVAL = 300
+# Metadata of data files found without a metadata file (None to ignore them)
+FSET_WATCH_REGISTER_META = {
+    'user' : '_census_',
+    'tags' : [],
+    'read_user' : [],
+    'read_group' : ['_census_'],
+    'change_user' : [],
+    'change_group' : ['_census_']
+}
+
+# Metadata files are written behind the fset updates
+# fsync policy: 'always', 'batch' or 'never'
+METADATA_FSYNC = 'batch'
+# Where metadata is kept:
+#   'sidecar'  - one .<filename>.json per data file
+#   'manifest' - one .census_manifest.ndjson per directory, appended on every
+#                change (python metastore.py migrate <file_dir> moves the
+#                metadata files into manifests)
+# Both are read, the store of the backend wins for files in both
+METADATA_BACKEND = 'sidecar'
+# Manifests with more than this many lines per file (and at least
+# MANIFEST_COMPACT_MIN_LINES lines) are rewritten
+MANIFEST_COMPACT_RATIO = 2
+MANIFEST_COMPACT_MIN_LINES = 1000
+
+# FileSet builds
+# Threads listing directories while walking file_dir
+TREE_SCAN_WORKERS = 8
+
+# HTTP downloads (/transfer/http)
+# Parallel Range requests per download
+DOWNLOAD_WORKERS = 4
+# Files are split in segments of at least this size
+DOWNLOAD_MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+# Largest read, chunks grow from CHUNK_SIZE up to this
+DOWNLOAD_MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# Retries of a failed segment
+DOWNLOAD_RETRIES = 3
+
+# Zip extraction (extract=true)
+# Processes decompressing members
+UNZIP_WORKERS = 4
+# Archives whose known members add up to less than this are extracted in process
+UNZIP_MIN_PARALLEL_SIZE = 64 * 1024 * 1024
+
+# Background transfer jobs, their state is kept in transfer_db_file
+# Transfers running at once, per server process
+TRANSFER_WORKERS = 4
+# Transfers running at once against the same host, unless in TRANSFER_HOST_LIMITS
+TRANSFER_DEFAULT_HOST_LIMIT = 2
+# host -> transfers running at once against it
+TRANSFER_HOST_LIMITS = {}
+# Finished jobs kept for polling
+TRANSFER_JOB_HISTORY = 1000
+
+# SSH transfers (/transfer/ssh)
+# Seconds an unused ssh session stays open
+SSH_IDLE_TIMEOUT = 300
+# Seconds between keepalive packets
+SSH_KEEPALIVE = 30
+# SSH window size (bytes in flight per channel)
+SSH_WINDOW_SIZE = 16 * 1024 * 1024
+# SFTP channels downloading in parallel
+SSH_CHANNELS = 4
@@ -4,100 +4,24 @@ import datetime
 import re
 import duckdb
 import logging
-import json
+import threading
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import pyarrow as pa
 from census_logging import * 
+from metastore import SidecarWriter, MANIFEST_FILENAME, read_manifest, remove_metadata
 
 # Get the maestro logger
 fsys_logger = logging.getLogger('maestro')
 
-class FileSet:
-    def __init__(self, file_dir, file_filter):
-        self.conn = duckdb.connect(':default:')
-        self.file_dir = file_dir
-        self.tree = []
-        self.filelist = []
-        self.filelist_full = []
-        self.filenames = []
-        self.pattern = ''
-        self.type = []
-        self.base_path = []
-        self.recursive = True
-        self.origin = []
-        self.tags = []
-        self.created_after = '-infinity'
-        self.created_before = 'infinity'
-        self.visibility = []
-        self.status = []
-        self.action = 'read'
-        self.user = '_census_'
-        if self.user == '':
-            raise Exception('FileSet creation without user')
-        self.groups = '_census_'
-        if self.user == []:
-            raise Exception('FileSet creation without groups')
-        # In case we supply the filter, update it
-        if file_filter:
-            self.update_filter(file_filter)
-        # Build the tree
-        self.build_tree()
-        # Build fset with all files under the tree
-        self.build_fset()
-        return
+# Version of the catalog layout. A catalog with another version is rebuilt
+CATALOG_VERSION = '1'
 
-    def update_filter(self, file_filter):
-        #Update filter values
-        self.filenames = file_filter.get('filenames', self.filenames)
-        self.pattern =  file_filter.get('pattern', self.pattern)
-        self.type = file_filter.get('type', self.type)
-        self.base_path = file_filter.get('base_path', self.base_path)
-        self.recursive = file_filter.get('recursive', self.recursive)
-        self.origin = file_filter.get('origin', self.origin)
-        self.tags = file_filter.get('tags', self.tags)
-        self.created_after = file_filter.get('created_after', self.created_after)
-        self.created_before = file_filter.get('created_before', self.created_before)
-        self.visibility = file_filter.get('visibility', self.status)
-        self.status = file_filter.get('status', self.status)
-        self.action = file_filter.get('action', 'change')
-        self.user = file_filter.get('user', '')
-        if self.user == '':
-            raise Exception('FileSet request without user')
-        self.groups = file_filter.get('groups', [])
-        if self.groups == []:
-            raise Exception('FileSet request without groups')
-        return
-        
-    def build_tree(self):
-        # Retrieve all files from the base_path
-        # If recursive, look for all subdirectories
-        if self.recursive:
-            # build the base path from user
-            path = ''
-            for sub in self.base_path:
-                path = os.path.join(path, sub)
-            # call the recursive function that parses all subdirectories
-            self.tree = self.__get_tree(os.path.join(self.file_dir, path))
-    
-    # Function to recurrently parse all subdirectories
-    # Call only from withing the class
-    def __get_tree(self, path):
-        # Add base directory
-        tree = [path]
-        # Find subdirectories
-        directories =  [f for f in os.listdir(path) if os.path.isdir(os.path.join(path, f))]
-        for directory in directories:
-            # Call itself for the subdirectory
-            tree = tree + self.__get_tree(os.path.join(path, directory))
-        return tree
-
-    # Insert all files into the fset database
-    def build_fset(self):
-        # Remove the previous table if existing
-        try:
-            self.conn.execute('DROP TABLE fset')
-        except Exception as error:
-            fsys_logger.debug(error)
-        # Create table
-        self.conn.execute("""CREATE TABLE fset(
+# path_str is not metadata: path joined ('a/b'), kept so path filters and
+# lookups compare one string instead of joining the path of every file
+# It is set on insert and not saved in the catalog file
+FSET_DDL = """CREATE TABLE fset(
                 filename VARCHAR,
                 type VARCHAR,
                 path VARCHAR[],
@@ -112,248 +36,701 @@ class FileSet:
                 read_user VARCHAR[],
                 read_group VARCHAR[],
                 change_user VARCHAR[],
-                change_group VARCHAR[])""")
-        # Read .*.json from all directories
-        for path in self.tree:
-            # check if there are metadata files, otherwise break 
-            files = [f for f in os.listdir(path) if (os.path.isfile(os.path.join(path, f))
-                                                     and re.match(r'\B\..*\.json\Z', f))]
-            if files:
-                req = os.path.join(path , ".*.json")
+                change_group VARCHAR[],
+                path_str VARCHAR)"""
+
+FSET_COLUMNS = ['filename', 'type', 'path', 'origin', 'tags', 'created', 'removed',
+                'hidden', 'processed', 'owner', 'changed_by', 'read_user',
+                'read_group', 'change_user', 'change_group']
+
+# Metadata columns of FSET_DDL, for rows built in memory
+FSET_SCHEMA = pa.schema([
+    ('filename', pa.string()),
+    ('type', pa.string()),
+    ('path', pa.list_(pa.string())),
+    ('origin', pa.list_(pa.string())),
+    ('tags', pa.list_(pa.string())),
+    ('created', pa.timestamp('us')),
+    ('removed', pa.timestamp('us')),
+    ('hidden', pa.bool_()),
+    ('processed', pa.bool_()),
+    ('owner', pa.string()),
+    ('changed_by', pa.string()),
+    ('read_user', pa.list_(pa.string())),
+    ('read_group', pa.list_(pa.string())),
+    ('change_user', pa.list_(pa.string())),
+    ('change_group', pa.list_(pa.string()))])
+
+# 'removed' of files that haven't been removed (UTC)
+REMOVED_NEVER = datetime.datetime(2100, 1, 1)
+
+# FileSet versions, unique across FileSets (a rebuild creates a new one)
+FSET_VERSIONS = itertools.count(1)
+
+# fset columns from metadata, for INSERT ... SELECT
+FSET_SELECT = ", ".join(FSET_COLUMNS)
+
+# path_str of a path ('a/b'), '' for file_dir itself
+PATH_STR = "coalesce(array_to_string({}, '/'), '')"
+
+# Smallest string greater than every string starting with prefix
+def prefix_end(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+# Metadata file of a data file: .<filename>.json
+METADATA_FILE = re.compile(r'\B\..*\.json\Z')
+
+# Manifest records as read by read_json: the fset metadata columns, times as
+# written (local time with offset), and deleted
+MANIFEST_COLUMNS = ("{" + ", ".join("'{}' : '{}'".format(column, type_) for column, type_ in
+                     [('filename', 'VARCHAR'), ('type', 'VARCHAR'), ('path', 'VARCHAR[]'),
+                      ('origin', 'VARCHAR[]'), ('tags', 'VARCHAR[]'), ('created', 'VARCHAR'),
+                      ('removed', 'VARCHAR'), ('hidden', 'BOOLEAN'), ('processed', 'BOOLEAN'),
+                      ('owner', 'VARCHAR'), ('changed_by', 'VARCHAR'), ('read_user', 'VARCHAR[]'),
+                      ('read_group', 'VARCHAR[]'), ('change_user', 'VARCHAR[]'),
+                      ('change_group', 'VARCHAR[]'), ('deleted', 'BOOLEAN')]) + "}")
+
+# Wildcards of read_json file names
+GLOB_CHARS = re.compile(r'[*?\[]')
+
+# One directory of the tree: its mtime (ns, taken before listing, so later
+# changes are caught next time), subdirectories and metadata files (including
+# its manifest). Appends to the manifest don't change the directory, the
+# mtime is the manifest's when it is newer
+# The type of each entry comes from the directory listing, no stat per entry
+def scan_dir(path):
+    mtime = os.stat(path).st_mtime_ns
+    subdirs = []
+    meta_files = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif METADATA_FILE.match(entry.name) and entry.is_file():
+                meta_files.append(entry.name)
+            elif entry.name == MANIFEST_FILENAME:
+                meta_files.append(entry.name)
+                mtime = max(mtime, entry.stat().st_mtime_ns)
+    return mtime, subdirs, meta_files
+
+# Walk the tree under path, listing directories on a pool of threads (on
+# network filesystems most of the time is waiting for the server)
+# Returns the directories, each one before its subdirectories, and
+# directory -> (mtime, metadata files). Directories that can't be read are
+# left out with everything below them
+def scan_tree(path, workers):
+    scanned = {}
+    children = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(scan_dir, path) : path}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory = pending.pop(future)
                 try:
-                    self.conn.execute("""INSERT INTO fset SELECT * FROM read_json($dir, auto_detect=true, union_by_name=true)""",
-                                { "dir" : req }
-                    )
-                except Exception as error:
+                    mtime, subdirs, meta_files = future.result()
+                except OSError as error:
+                    if directory == path:
+                        raise
                     fsys_logger.debug(error)
-                
-    def get_files(self, file_filter):
-        #Update filter values if filter is provided
-        if file_filter:
-            self.update_filter(file_filter)
-        
-        # Create a Relation with everything available
-        flist_ref = self.conn.sql('SELECT * FROM fset')
-        # Create an empty Relation
-        flist_empty = self.conn.sql("SELECT * FROM flist_ref LIMIT 0")
-        # Create the result flist
-        flist = self.conn.sql("SELECT * FROM flist_ref LIMIT 0")
+                    continue
+                scanned[directory] = (mtime, meta_files)
+                children[directory] = subdirs
+                for subdir in subdirs:
+                    pending[pool.submit(scan_dir, subdir)] = subdir
+    tree = []
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        if directory not in scanned:
+            continue
+        tree.append(directory)
+        stack.extend(reversed(children[directory]))
+    return tree, scanned
+
+# Run the method holding the FileSet lock
+# The FileSet is shared by request threads and the watcher
+def locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+# Filter of a FileSet request
+# Every request is read on its own, what isn't given takes the default
+class FileFilter:
+    def __init__(self, file_filter):
+        self.filenames = file_filter.get('filenames', [])
+        self.pattern =  file_filter.get('pattern', '')
+        self.type = file_filter.get('type', [])
+        self.base_path = file_filter.get('base_path', [])
+        self.recursive = file_filter.get('recursive', True)
+        self.origin = file_filter.get('origin', [])
+        self.tags = file_filter.get('tags', [])
+        self.created_after = file_filter.get('created_after', '-infinity')
+        self.created_before = file_filter.get('created_before', 'infinity')
+        self.visibility = file_filter.get('visibility', [])
+        self.status = file_filter.get('status', [])
+        self.action = file_filter.get('action', 'change')
+        self.user = file_filter.get('user', '')
+        if self.user == '':
+            raise Exception('FileSet request without user')
+        self.groups = file_filter.get('groups', [])
+        if self.groups == []:
+            raise Exception('FileSet request without groups')
+
+    # Compile the filter into a single WHERE clause with bound parameters
+    # Returns the clause and the parameters dict for conn.execute
+    def compile(self):
+        where = []
+        params = {}
 
         # Filter on filenames
-        if self.filenames:            
-            # Create an empty Relation
-            flist_tmp = self.conn.sql("select * from flist_ref limit 0")
-            for filename in self.filenames:
-                # Filter each filename
-                flist_proc = flist_ref.filter ("filename = '{}'".format(filename))
-                # Find what's new
-                flist_new = flist_proc.except_(flist_tmp)
-                # Add result to the cummulative list
-                flist_tmp = flist_tmp.union(flist_new)
-            # Update flist_ref
-            flist = flist_empty.union(flist_tmp)
-        else:
-            flist = flist.union(flist_ref)
+        if self.filenames:
+            where.append("list_contains($filenames, filename)")
+            params['filenames'] = list(self.filenames)
 
         # Filter on GLOB (filename regex)
         if self.pattern:
-            flist = flist.filter("filename GLOB '{}'".format(self.pattern))
-
-        ### TO DO
-        ### Replace list searches with list_has_any nested function from duckdb!
-        ### tags = ['import', 'http']
-        ### f = f.filter("list_has_any(origin::VARCHAR[], {})".format(tags))
-        ### list_has_any will be available in 0.8.2 (code already tested with nightly builts)!!!
-        
+            where.append("filename GLOB $pattern")
+            params['pattern'] = self.pattern
+
         # Filter on type
-        if self.type:            
-            # Create an empty Relation
-            flist_tmp = self.conn.sql("select * from flist_ref limit 0")
-            for ftype in self.type:
-                # Filter each filetype
-                flist_proc = flist.filter ("type = '{}'".format(ftype))
-                # Find what's new
-                flist_new = flist_proc.except_(flist_tmp)
-                # Add result to the cummulative list
-                flist_tmp = flist_tmp.union(flist_new)
-            # Update flist_ref
-            flist = flist_empty.union(flist_tmp)
+        if self.type:
+            where.append("list_contains($type, type)")
+            params['type'] = list(self.type)
 
         # Filter on visibilty (no visibility means all)
         if self.visibility:
-            # Create an empty Relation
-            flist_tmp = self.conn.sql("select * from flist_ref limit 0")            
-            # Filter on status hidden
+            hidden = []
             if 'hidden' in self.visibility:
-                flist_tmp = flist.filter('hidden = true')
-            # Filter on status unhidden
+                hidden.append("hidden = true")
             if 'unhidden' in self.visibility:
-                flist_proc = flist.filter('hidden = false')
-                flist_tmp = flist_proc.union(flist_tmp)
-            # Update flist
-            flist = flist_empty.union(flist_tmp)
+                hidden.append("hidden = false")
+            where.append("(" + (" OR ".join(hidden) or "false") + ")")
 
         # Filter on dates
         if self.created_after:
-            flist = flist.filter("created > '{}'".format(self.created_after))
+            where.append("created > CAST($created_after AS TIMESTAMP)")
+            params['created_after'] = self.created_after
         if self.created_before:
-            flist = flist.filter("created < '{}'".format(self.created_before))
+            where.append("created < CAST($created_before AS TIMESTAMP)")
+            params['created_before'] = self.created_before
 
         # Filter on processed status (no status means all)
         if self.status:
-            # Create an empty Relation
-            flist_tmp = self.conn.sql("select * from flist_ref limit 0")            
-            # Filter on status processed
+            processed = []
             if 'processed' in self.status:
-                flist_tmp = flist.filter('processed = true')
-            # Filter on status unprocessed
+                processed.append("processed = true")
             if 'unprocessed' in self.status:
-                flist_proc = flist.filter('processed = false')
-                flist_tmp = flist_proc.union(flist_tmp)
-            # Update flist
-            flist = flist_empty.union(flist_tmp)
-            
+                processed.append("processed = false")
+            where.append("(" + (" OR ".join(processed) or "false") + ")")
+
         # Filter on path
         path_base = ''
         for sub in self.base_path:
             path_base = os.path.join(path_base, sub)
         if path_base:
-            # Just execute if there is a path to filter. Otherwise do nothing
             # Filter all files that concat path starts with path_base
-            flist = flist.filter("starts_with(array_to_string(path, '/'), '{}')".format(path_base))
+            where.append("path_str >= $path_base AND path_str < $path_end")
+            params['path_base'] = path_base
+            params['path_end'] = prefix_end(path_base)
 
-        # Read or Change
+        # Read or Change. The user sees files it is allowed to, files of its
+        # groups and the files it owns
         if self.action == 'read':
-            # Define Filter for the user
-            filter_user = "list_contains(read_user, '{}')"
-            # define filter for the group
-            filter_group = "list_contains(read_group, '{}')"
+            where.append("(list_contains(read_user, $user) OR list_has_any(read_group, $groups) OR owner = $user)")
         else:
-            # Define Filter for the user
-            filter_user = "list_contains(change_user, '{}')"
-            # define filter for the group
-            filter_group = "list_contains(change_group, '{}')"           
-        # Apply user filter
-        flist_tmp = flist.filter (filter_user.format(self.user))
-        # The user may belong to multiple groups. Check each one individualy
-        for u_group in self.groups:
-            # Filter based on the group
-            flist_group = flist.filter (filter_group.format(u_group))
-            # Find what's new
-            flist_new = flist_group.except_(flist_tmp)
-            # Add result to the cummulative list
-            flist_tmp = flist_tmp.union(flist_new)
-        # Add up all files under the user ownership
-        flist_owner = flist.filter("owner = '{}'".format(self.user))
-        flist_new = flist_owner.except_(flist_tmp)
-        # Update flist
-        flist = flist_tmp.union(flist_new)
-            
+            where.append("(list_contains(change_user, $user) OR list_has_any(change_group, $groups) OR owner = $user)")
+        params['user'] = self.user
+        params['groups'] = list(self.groups)
+
         # Filter on tags (no tags means all)
-        if self.tags:            
-            # Create an empty Relation
-            flist_tmp = self.conn.sql("select * from flist_ref limit 0")
-            for tag in self.tags:
-                # Filter each tag
-                flist_tag = flist.filter ("list_contains(tags, '{}')".format(tag))
-                # Find what's new
-                flist_new = flist_tag.except_(flist_tmp)
-                # Add result to the cummulative list
-                flist_tmp = flist_tmp.union(flist_new)
-            # Update flist_ref
-            flist = flist_empty.union(flist_tmp)
+        if self.tags:
+            where.append("list_has_any(tags, $tags)")
+            params['tags'] = list(self.tags)
 
         # Filter on origin (no origin means all)
-        if self.origin:            
-            # Create an empty Relation
-            flist_tmp = self.conn.sql("select * from flist_ref limit 0")
-            for origin in self.origin:
-                # Filter each origin
-                flist_proc = flist.filter ("list_contains(origin, '{}')".format(origin))
-                # Find what's new
-                flist_new = flist_proc.except_(flist_tmp)
-                # Add result to the cummulative list
-                flist_tmp = flist_tmp.union(flist_new)
-            # Update flist_ref
-            flist = flist_empty.union(flist_tmp)
-            
-        #Build filelist
-        flist_sql = self.conn.sql("select filename, array_to_string(path, '/') from flist")
-        flist_list = flist_sql.fetchall()
-        self.filelist = [ os.path.join(file_dir, path, file) for file, path in flist_list]
-
-        #Build flist_full - json array with files
-        resp = flist.fetchall()
-        columns = flist.columns
-        self.filelist_full =  [dict(zip(columns,register)) for register in resp]
+        if self.origin:
+            where.append("list_has_any(origin, $origin)")
+            params['origin'] = list(self.origin)
+
+        return " AND ".join(where), params
+
+# fset_list() bound to the given files, for this connection (cursor) only
+# It takes precedence over the fset_list UDF registered on the database
+def bind_fset_list(duck_cursor, files):
+    if files:
+        files_list = "[" + ", ".join("'" + file.replace("'", "''") + "'" for file in files) + "]"
+    else:
+        files_list = "[]::VARCHAR[]"
+    duck_cursor.execute("CREATE OR REPLACE TEMP MACRO fset_list() AS " + files_list)
+
+# The files selected by a filter, at the FileSet version it was made
+# Selections are never changed, each request works on its own
+# The metadata is kept as an Arrow table (fset columns), Python objects are
+# only made for what is asked for
+class FileSelection:
+    def __init__(self, file_filter, table, file_dir, version):
+        self.filter = file_filter
+        self.table = table
+        self.file_dir = file_dir
+        self.version = version
+
+    def __len__(self):
+        return self.table.num_rows
+
+    # Full filenames, what fset_list() returns
+    @functools.cached_property
+    def filelist(self):
+        return tuple(os.path.join(self.file_dir, path, filename)
+                     for path, filename in zip(self.path_strs().to_pylist(),
+                                               self.table['filename'].to_pylist()))
+
+    # Path of each file as a string ('a/b'), as Arrow
+    def path_strs(self):
+        return self.table['path_str']
+
+    # Metadata of the files from offset, at most limit of them, as dicts
+    # fields: the columns to return, all of them if None
+    def rows(self, offset=0, limit=None, fields=None):
+        if fields:
+            for field in fields:
+                if field not in FSET_COLUMNS:
+                    raise Exception('Unknown metadata field: ' + field)
+        else:
+            fields = FSET_COLUMNS
+        return self.table.slice(offset, limit).select(fields).to_pylist()
+
+    # fset_list() of duck_cursor returns this selection
+    def bind(self, duck_cursor):
+        bind_fset_list(duck_cursor, self.filelist)
+
+class FileSet:
+    # catalog_file: persistent DuckDB file with the fset table and the mtime of
+    # each directory when it was loaded. Only changed directories are reloaded
+    # rebuild: ignore the catalog and reload every directory
+    # writer: SidecarWriter for the metadata files (shared across rebuilds)
+    def __init__(self, file_dir, file_filter, catalog_file=None, rebuild=False, writer=None):
+        # In-memory database of its own, rebuilds don't touch the FileSet in use
+        self.conn = duckdb.connect()
+        self.lock = threading.RLock()
+        if writer == None:
+            writer = SidecarWriter()
+        self.writer = writer
+        self.file_dir = file_dir
+        self.catalog_file = catalog_file
+        # fset changed since the last save of the catalog
+        self.dirty = False
+        # Changes whenever fset does, e.g. to tell cached query results apart
+        self.version = next(FSET_VERSIONS)
+        self.tree = []
+        # directory -> (mtime, metadata files) of the last walk, until loaded
+        self.scanned = {}
+        # directory -> mtime (ns) when its metadata files were loaded
+        self.dirs = {}
+        # Subtree of file_dir held by the FileSet, from the filter
+        file_filter = file_filter or {}
+        self.base_path = file_filter.get('base_path', [])
+        self.recursive = file_filter.get('recursive', True)
+        # Build the tree
+        self.build_tree()
+        # The catalog covers the whole file_dir, not subtrees
+        if self.base_path or not self.recursive:
+            self.catalog_file = None
+        # Start from the catalog, if any
+        if self.catalog_file and not rebuild:
+            self.load_catalog()
+        # Build fset with all files under the tree
+        self.build_fset()
+        # Checkpoint
+        if self.catalog_file:
+            self.save_catalog()
         return
-    
-    def new_file(self, meta, origin):
+
+    def build_tree(self):
+        # Metadata files queued so far must be on disk before listing them
+        self.writer.flush()
+        # Retrieve all files from the base_path
+        # If recursive, look for all subdirectories
+        if self.recursive:
+            # build the base path from user
+            path = ''
+            for sub in self.base_path:
+                path = os.path.join(path, sub)
+            # walk all subdirectories, listing their metadata files
+            self.tree, self.scanned = scan_tree(os.path.join(self.file_dir, path), TREE_SCAN_WORKERS)
+
+    # Insert all files into the fset database
+    # Directories whose mtime hasn't changed since they were loaded are skipped
+    def build_fset(self):
+        # Create table if not loaded from the catalog
+        if not self.dirs:
+            self.conn.execute('DROP TABLE IF EXISTS fset')
+            self.conn.execute(FSET_DDL)
+        # Read the metadata files of changed directories, as listed by build_tree
+        changed = { path : scan for path, scan in self.scanned.items() if self.dirs.get(path, None) != scan[0] }
+        self.scanned = {}
+        self.__load_dirs(changed)
+        reloaded = len(changed)
+        # Remove directories that are gone
+        tree = set(self.tree)
+        removed = [d for d in self.dirs if d not in tree]
+        self.__remove_dirs(removed)
+        for path in removed:
+            del self.dirs[path]
+        if reloaded or removed:
+            self.version = next(FSET_VERSIONS)
+        fsys_logger.debug("fset loaded, directories reloaded: " + str(reloaded))
+
+    # Reconcile the whole tree by directory mtime
+    @locked
+    def refresh(self):
+        self.build_tree()
+        self.build_fset()
+        self.__changed()
+
+    # Apply changes of the given directories (e.g. reported by the watcher)
+    # register_meta: metadata for data files without a metadata file. When
+    # given, they are registered with origin 'watch'
+    @locked
+    def refresh_dirs(self, dirs, register_meta=None):
+        # Metadata files queued so far must be on disk before looking at them
+        self.writer.flush()
+        tree = set(self.tree)
+        root = os.path.join(self.file_dir, '')
+        refreshed = 0
+        load_dirs = []
+        register = []
+        for path in sorted(dirs):
+            if not (path + '/').startswith(root):
+                continue
+            if os.path.isdir(path):
+                if path in tree:
+                    new_dirs = [path]
+                else:
+                    # New directory, with everything below it
+                    new_dirs, _ = scan_tree(path, TREE_SCAN_WORKERS)
+                for new_dir in new_dirs:
+                    if new_dir not in tree:
+                        self.tree.append(new_dir)
+                        tree.add(new_dir)
+                    register += self.__sync_dir(new_dir, register_meta)
+                    load_dirs.append(new_dir)
+            else:
+                # Directory gone, with everything below it
+                gone = [d for d in self.tree if d == path or d.startswith(path + '/')]
+                for gone_dir in gone:
+                    self.tree.remove(gone_dir)
+                    tree.discard(gone_dir)
+                    self.dirs.pop(gone_dir, None)
+                    refreshed += 1
+                self.__remove_dirs(gone)
+        # Register new data files, all at once
+        if register:
+            self.new_files(register, 'watch')
+            self.writer.flush()
+        # Listed again, after the changes above
+        scanned = {}
+        for path in load_dirs:
+            mtime, _, meta_files = scan_dir(path)
+            scanned[path] = (mtime, meta_files)
+        self.__load_dirs(scanned)
+        refreshed += len(scanned)
+        self.__changed()
+        fsys_logger.debug("fset refreshed, directories: " + str(refreshed))
+
+    # Match data files and metadata files of a directory
+    # Metadata of deleted data files is removed
+    # Returns the metadata to register data files without metadata, if
+    # register_meta is given
+    def __sync_dir(self, path, register_meta):
+        data_files = set()
+        meta_files = set()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                if METADATA_FILE.match(entry.name):
+                    meta_files.add(entry.name[1:-len('.json')])
+                elif entry.name == MANIFEST_FILENAME:
+                    meta_files.update(read_manifest(entry.path))
+                elif not entry.name.startswith('.'):
+                    data_files.add(entry.name)
+        deleted = sorted(meta_files - data_files)
+        if deleted:
+            try:
+                remove_metadata(path, deleted)
+                fsys_logger.debug("removed metadata of deleted files: " + path + " " + str(deleted))
+            except OSError as error:
+                fsys_logger.debug(error)
+        if register_meta == None:
+            return []
+        register = []
+        local_path = self.__dir_path(path)
+        for filename in sorted(data_files - meta_files):
+            root, ext = os.path.splitext(filename)
+            # Known file extensions
+            if ext not in KNOWN_EXTENSIONS:
+                continue
+            meta = dict(register_meta)
+            meta['filename'] = filename
+            meta['type'] = ext.replace('.', '')
+            meta['local_path'] = local_path.split('/') if local_path else []
+            register.append(meta)
+            fsys_logger.debug("registering file: " + os.path.join(path, filename))
+        return register
+
+    def __changed(self):
+        self.dirty = True
+        self.version = next(FSET_VERSIONS)
+
+    # Save the catalog if fset changed since the last save
+    @locked
+    def checkpoint(self):
+        if self.dirty and self.catalog_file:
+            self.save_catalog()
+            self.dirty = False
+
+    # Relative path of a directory as stored in the metadata ('a/b')
+    def __dir_path(self, path):
+        rel_path = os.path.relpath(path, self.file_dir)
+        if rel_path == '.':
+            return ''
+        return rel_path
+
+    def __remove_dirs(self, paths):
+        if paths:
+            self.conn.execute("DELETE FROM fset WHERE path_str IN (SELECT unnest($paths))",
+                              { "paths" : [self.__dir_path(path) for path in paths] })
+
+    # Replace the files of the given directories with their metadata files
+    # scanned: directory -> (mtime, metadata files), as from scan_tree
+    # All metadata files are read by a single read_json, and all manifests by
+    # another. The store of the writer's backend goes first, the other only
+    # adds the files not in it. If one of them can't be read, directories are
+    # loaded one at a time and only its directory is left out
+    def __load_dirs(self, scanned):
+        if not scanned:
+            return
+        self.__remove_dirs(list(scanned))
+        files = []
+        manifests = []
+        for path, (mtime, meta_files) in scanned.items():
+            if MANIFEST_FILENAME in meta_files:
+                manifests.append(os.path.join(path, MANIFEST_FILENAME))
+                meta_files = [name for name in meta_files if name != MANIFEST_FILENAME]
+            if any(GLOB_CHARS.search(name) for name in meta_files):
+                # read_json takes names as glob patterns, match the whole directory instead
+                files.append(os.path.join(path, '.*.json'))
+            else:
+                files += [os.path.join(path, name) for name in meta_files]
+        loads = [(self.__insert_sidecars, files), (self.__insert_manifests, manifests)]
+        if self.writer.backend == 'manifest':
+            loads.reverse()
+        if files or manifests:
+            try:
+                new_only = False
+                for insert, filenames in loads:
+                    if filenames:
+                        insert(filenames, new_only)
+                    new_only = True
+            except Exception as error:
+                fsys_logger.debug(error)
+                if len(scanned) > 1:
+                    for path, scan in scanned.items():
+                        self.__load_dirs({ path : scan })
+                    return
+        for path, (mtime, meta_files) in scanned.items():
+            self.dirs[path] = mtime
+
+    # Condition on metadata rows, files already in fset are skipped when new_only
+    def __new_only(self, new_only):
+        if not new_only:
+            return "true"
+        return """NOT EXISTS (SELECT 1 FROM fset AS loaded WHERE loaded.filename = metadata.filename
+                              AND loaded.path_str = """ + PATH_STR.format('metadata.path') + ")"
+
+    def __insert_sidecars(self, files, new_only):
+        self.conn.execute("INSERT INTO fset SELECT " + FSET_SELECT + ", " + PATH_STR.format('path') + """
+                             FROM read_json($files, auto_detect=true, union_by_name=true) AS metadata
+                             WHERE """ + self.__new_only(new_only), { "files" : files })
+
+    # The last record of each file, unless it's deleted
+    # Lines that can't be read (e.g. cut by a crash) come as NULL and are skipped
+    def __insert_manifests(self, manifests, new_only):
+        self.conn.execute("INSERT INTO fset SELECT " + FSET_SELECT + ", " + PATH_STR.format('path') + """
+                             FROM (SELECT * FROM (SELECT *, row_number() OVER () AS line
+                                                  FROM read_json($files, format='newline_delimited', ignore_errors=true,
+                                                                 columns=""" + MANIFEST_COLUMNS + """))
+                                   WHERE filename IS NOT NULL
+                                   QUALIFY row_number() OVER (PARTITION BY """ + PATH_STR.format('path') + """, filename
+                                                              ORDER BY line DESC) = 1) AS metadata
+                             WHERE deleted IS NOT TRUE AND """ + self.__new_only(new_only), { "files" : manifests })
+
+    # Load fset and the directory checkpoint from the catalog file
+    def load_catalog(self):
+        if not os.path.exists(self.catalog_file):
+            return
+        try:
+            self.conn.execute("ATTACH '{}' AS fset_catalog (READ_ONLY)".format(self.catalog_file.replace("'", "''")))
+        except Exception as error:
+            fsys_logger.warning("Error opening catalog: " + str(error))
+            return
+        try:
+            version = self.conn.execute("SELECT value FROM fset_catalog.fset_info WHERE key = 'version'").fetchone()
+            if version == None or version[0] != CATALOG_VERSION:
+                fsys_logger.warning("Catalog version mismatch, rebuilding")
+                return
+            self.conn.execute('DROP TABLE IF EXISTS fset')
+            self.conn.execute(FSET_DDL)
+            self.conn.execute("INSERT INTO fset SELECT " + FSET_SELECT + ", " + PATH_STR.format('path') + """
+                                 FROM fset_catalog.fset""")
+            self.dirs = dict(self.conn.execute('SELECT dir, mtime FROM fset_catalog.fset_dirs').fetchall())
+            fsys_logger.debug("catalog loaded, directories: " + str(len(self.dirs)))
+        except Exception as error:
+            fsys_logger.warning("Error loading catalog: " + str(error))
+            self.dirs = {}
+        finally:
+            self.conn.execute('DETACH fset_catalog')
+
+    # Write fset and the directory checkpoint to the catalog file
+    # The catalog is written aside and renamed, so other workers either read
+    # the previous or the new one
+    def save_catalog(self):
+        tmp_file = self.catalog_file + '.' + str(os.getpid()) + '.tmp'
+        try:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            self.conn.execute("ATTACH '{}' AS fset_catalog_tmp".format(tmp_file.replace("'", "''")))
+            try:
+                self.conn.execute('CREATE TABLE fset_catalog_tmp.fset AS SELECT ' + FSET_SELECT + ' FROM fset')
+                self.conn.execute('CREATE TABLE fset_catalog_tmp.fset_dirs(dir VARCHAR, mtime BIGINT)')
+                self.conn.executemany('INSERT INTO fset_catalog_tmp.fset_dirs VALUES (?, ?)',
+                                      list(self.dirs.items()))
+                self.conn.execute('CREATE TABLE fset_catalog_tmp.fset_info(key VARCHAR, value VARCHAR)')
+                self.conn.execute("INSERT INTO fset_catalog_tmp.fset_info VALUES ('version', $version)",
+                                  { "version" : CATALOG_VERSION })
+            finally:
+                self.conn.execute('DETACH fset_catalog_tmp')
+            os.replace(tmp_file, self.catalog_file)
+            fsys_logger.debug("catalog saved, directories: " + str(len(self.dirs)))
+        except Exception as error:
+            fsys_logger.warning("Error saving catalog: " + str(error))
+
+    # Files selected by file_filter (dict), as a FileSelection
+    @locked
+    def get_files(self, file_filter):
+        file_filter = FileFilter(file_filter)
+        where, params = file_filter.compile()
+        table = self.conn.execute("SELECT " + FSET_SELECT + ", path_str FROM fset WHERE " + where, params).arrow()
+        return FileSelection(file_filter, table, self.file_dir, self.version)
+
+    # Metadata as written in the metadata file
+    # Timestamps are kept in UTC in fset and written in local time
+    def __sidecar(self, register):
         tz = pytz.timezone('Brazil/East')
-        new_meta = {
-            'filename' : meta['filename'],
-            'type' : meta['type'],
-            'path' : meta['local_path'],
-            'origin' : [origin],
-            'tags' : meta['tags'],
-            'created' : datetime.datetime.now(tz=tz).strftime('%Y-%m-%d %H:%M:%S.%f%z'),
-            'removed' : '2100-01-01 00:00:00.000000-0000',
-            'hidden' : False,
-            'processed' : False,
-            'owner' : meta['user'],
-            "changed_by" : meta['user'],
-            "read_user" : meta['read_user'],
-            "read_group" : meta['read_group'],
-            "change_user" : meta['change_user'],
-            "change_group" : meta['change_group']            
-        }
-        meta_data = json.dumps([new_meta], indent=4)
-        local_path = '/'.join(meta['local_path'])
-        filename = '.' + meta['filename'] + '.json'
-        full_filename = os.path.join(self.file_dir, local_path, filename)
-
-        # Write the json file
-        with open(full_filename, 'w') as f_out:
-            f_out.write(meta_data)
+        file = dict(register)
+        for column in ('created', 'removed'):
+            time_ = file[column].replace(tzinfo=pytz.UTC).astimezone(tz=tz)
+            file[column] = time_.strftime('%Y-%m-%d %H:%M:%S.%f%z')
+        local_path = '/'.join(file['path'])
+        return self.writer.metadata(os.path.join(self.file_dir, local_path), file)
+
+    # Queue the metadata of the given fset rows, for the writer's backend
+    def __write_sidecars(self, rows):
+        self.writer.write_many([self.__sidecar(register) for register in rows])
 
+    # Create (or replace) the metadata of many files in one transaction
+    @locked
+    def new_files(self, metas, origin):
+        now = datetime.datetime.now(tz=pytz.UTC).replace(tzinfo=None)
+        rows = []
+        for meta in metas:
+            rows.append({
+                'filename' : meta['filename'],
+                'type' : meta['type'],
+                'path' : list(meta['local_path']),
+                'origin' : [origin],
+                'tags' : meta['tags'],
+                'created' : now,
+                'removed' : REMOVED_NEVER,
+                'hidden' : False,
+                'processed' : False,
+                'owner' : meta['user'],
+                "changed_by" : meta['user'],
+                "read_user" : meta['read_user'],
+                "read_group" : meta['read_group'],
+                "change_user" : meta['change_user'],
+                "change_group" : meta['change_group']
+            })
+        if not rows:
+            return
+        new_rows = pa.Table.from_pylist(rows, schema=FSET_SCHEMA)
         # Update fset
-        # Remove if there is the same file already there        
+        # Remove if there is the same file already there
         try:
-            self.conn.execute("DELETE FROM fset WHERE array_to_string(path, '/') = '{}' AND filename = '{}'".format(local_path, meta['filename']))
-            self.conn.execute("INSERT INTO fset SELECT * FROM read_json('{}', auto_detect=true, union_by_name=true)".format(full_filename))
+            self.conn.begin()
+            self.conn.register('fset_new_rows', new_rows)
+            self.conn.execute("""DELETE FROM fset USING fset_new_rows
+                                 WHERE fset.filename = fset_new_rows.filename
+                                 AND fset.path_str = """ + PATH_STR.format('fset_new_rows.path'))
+            self.conn.execute("INSERT INTO fset SELECT " + FSET_SELECT + ", " + PATH_STR.format('path') + """
+                                 FROM fset_new_rows""")
+            self.conn.commit()
         except Exception as error:
-            fsys_logger.debug(error)
+            self.conn.rollback()
+            fsys_logger.error(error)
+            return
+        finally:
+            self.conn.unregister('fset_new_rows')
+        self.__changed()
+        # Write the json files
+        self.__write_sidecars(rows)
 
+    def new_file(self, meta, origin):
+        self.new_files([meta], origin)
+
+    # Change the metadata of the files of selection
     # meta contains all fields that must be changed. all items not specified should be kept unchanged
-    def update_file(self, meta, user):
-        tz = pytz.timezone('Brazil/East')
-        # Assume the list of files has been already selected. With multi-access THIS MUST CHANGE
-        for file in self.filelist_full:
-            # change only the keys specified in meta
-            for param in meta.keys():
-                file[param] = meta[param]
-            # Forced updates
-            file['changed_by'] = user
-            # We must change UTC time to string
-            time_ = file['created'].replace(tzinfo=pytz.UTC).astimezone(tz=tz)
-            file['created'] = time_.strftime('%Y-%m-%d %H:%M:%S.%f%z')
-            time_ = file['removed'].replace(tzinfo=pytz.UTC).astimezone(tz=tz)
-            file['removed'] = time_.strftime('%Y-%m-%d %H:%M:%S.%f%z')
-            
-            
-            meta_data = json.dumps([file], indent=4)
-            local_path = '/'.join(file['path'])
-            filename = '.' + file['filename'] + '.json'
-            full_filename = os.path.join(self.file_dir, local_path, filename)
-    
-            # Write the json file
-            with open(full_filename, 'w') as f_out:
-                f_out.write(meta_data)
-    
-            # Update fset
-            # Remove if there is the same file already there        
-            try:
-                self.conn.execute("DELETE FROM fset WHERE array_to_string(path, '/') = '{}' AND filename = '{}'".format(local_path, file['filename']))
-                self.conn.execute("INSERT INTO fset SELECT * FROM read_json('{}', auto_detect=true, union_by_name=true)".format(full_filename))
-            except Exception as error:
-                fsys_logger.error(error)
+    # All files are updated with a single UPDATE, metadata files are written behind
+    # Files that already have the values in meta are left alone
+    @locked
+    def update_files(self, selection, meta, user):
+        if not len(selection) or not meta:
+            return
+        # Forced updates
+        changes = dict(meta)
+        changes['changed_by'] = user
+        for column in changes:
+            if column not in FSET_COLUMNS:
+                raise Exception('Unknown metadata field: ' + column)
+        set_clause = ", ".join("{} = $v_{}".format(column, column) for column in changes)
+        distinct = " OR ".join("fset.{} IS DISTINCT FROM $v_{}".format(column, column) for column in meta)
+        params = { "v_" + column : value for column, value in changes.items() }
+        if 'path' in changes:
+            set_clause += ", path_str = " + PATH_STR.format('$v_path')
+        keys = selection.table.select(['filename', 'path_str'])
+        try:
+            self.conn.begin()
+            self.conn.register('fset_keys', keys)
+            updated = self.conn.execute("""UPDATE fset SET """ + set_clause + """ FROM fset_keys
+                                           WHERE fset.filename = fset_keys.filename
+                                           AND fset.path_str = fset_keys.path_str
+                                           AND (""" + distinct + """)
+                                           RETURNING """ + ", ".join("fset." + column for column in FSET_COLUMNS),
+                                        params)
+            rows = [dict(zip(FSET_COLUMNS, register)) for register in updated.fetchall()]
+            self.conn.commit()
+        except Exception as error:
+            self.conn.rollback()
+            fsys_logger.error(error)
+            return
+        finally:
+            self.conn.unregister('fset_keys')
+        if not rows:
+            return
+        self.__changed()
+        # Write the json files
+        self.__write_sidecars(rows)
@@ -0,0 +1,172 @@
+import sys
+import time
+import uuid
+import threading
+import logging
+from collections import OrderedDict
+
+# Get the maestro logger
+cursor_logger = logging.getLogger('maestro')
+
+# Estimate the Python memory of a batch of rows
+# Only a sample of the rows is measured, the rest is extrapolated
+def estimate_size(rows, sample=100):
+    if not rows:
+        return 0
+    measured = rows[:sample]
+    size = 0
+    for row in measured:
+        size += sys.getsizeof(row)
+        for value in row:
+            size += sys.getsizeof(value)
+    return int(size * len(rows) / len(measured))
+
+# Server-side cursor over the result of one query
+# "duck_cursor" is an independent duckdb connection, so fetching does not
+# block nor is affected by other requests on the same database
+class SqlCursor:
+    def __init__(self, database, query, duck_cursor, result):
+        self.cursor_id = str(uuid.uuid4())
+        self.database = database
+        self.query = query
+        self.duck_cursor = duck_cursor
+        self.result = result
+        self.columns = result.columns
+        self.created = time.time()
+        self.last_used = time.monotonic()
+        self.rows_fetched = 0
+        self.bytes_fetched = 0
+        # Estimated memory held for this cursor (last batch served)
+        self.memory = 0
+        self.done = False
+        # Fetches of the same cursor are serialized
+        self.lock = threading.Lock()
+
+    def fetch(self, size):
+        with self.lock:
+            rows = self.result.fetchmany(size)
+            batch_bytes = estimate_size(rows)
+            self.rows_fetched += len(rows)
+            self.bytes_fetched += batch_bytes
+            self.memory = batch_bytes
+            self.last_used = time.monotonic()
+            # We have read it all
+            if len(rows) < size:
+                self.done = True
+            return rows
+
+    def close(self):
+        with self.lock:
+            self.done = True
+            self.result = None
+            try:
+                self.duck_cursor.close()
+            except Exception as error:
+                cursor_logger.debug(error)
+
+    def info(self):
+        return {"cursor_id" : self.cursor_id,
+                "database" : self.database,
+                "query" : self.query,
+                "columns" : self.columns,
+                "created" : self.created,
+                "idle" : time.monotonic() - self.last_used,
+                "rows_fetched" : self.rows_fetched,
+                "bytes_fetched" : self.bytes_fetched,
+                "memory" : self.memory}
+
+# Registry of the open cursors
+# Cursors expire after "ttl" seconds without a fetch. When the estimated memory
+# of all cursors exceeds "max_memory" or there are more than "max_open"
+# cursors, the least recently used ones are closed
+class CursorRegistry:
+    def __init__(self, max_open, ttl, max_memory):
+        self.max_open = max_open
+        self.ttl = ttl
+        self.max_memory = max_memory
+        # cursor_id -> SqlCursor, ordered from least to most recently used
+        self.cursors = OrderedDict()
+        self.lock = threading.Lock()
+
+    def open(self, database, query, duck_cursor, result):
+        cursor = SqlCursor(database, query, duck_cursor, result)
+        with self.lock:
+            self.cursors[cursor.cursor_id] = cursor
+            evicted = self.__evict(keep=cursor.cursor_id)
+        self.__close_cursors(evicted)
+        cursor_logger.debug("Opened cursor: " + cursor.cursor_id + " database: " + database)
+        return cursor
+
+    def get(self, cursor_id):
+        with self.lock:
+            cursor = self.cursors.get(cursor_id, None)
+            if cursor != None:
+                self.cursors.move_to_end(cursor_id)
+            return cursor
+
+    # Fetch from the cursor, closing it when it's exhausted
+    def fetch(self, cursor, size):
+        rows = cursor.fetch(size)
+        if cursor.done:
+            self.close(cursor.cursor_id)
+        else:
+            with self.lock:
+                evicted = self.__evict(keep=cursor.cursor_id)
+            self.__close_cursors(evicted)
+        return rows
+
+    def close(self, cursor_id):
+        with self.lock:
+            cursor = self.cursors.pop(cursor_id, None)
+        if cursor == None:
+            return False
+        self.__close_cursors([cursor])
+        return True
+
+    # Select cursors to be closed. Must be called with self.lock held
+    def __evict(self, keep=None):
+        evicted = []
+        now = time.monotonic()
+        # Expired cursors
+        for cursor_id, cursor in list(self.cursors.items()):
+            if cursor_id != keep and now - cursor.last_used > self.ttl:
+                evicted.append(self.cursors.pop(cursor_id))
+        # Too many cursors or too much memory, least recently used first
+        memory = sum(cursor.memory for cursor in self.cursors.values())
+        for cursor_id, cursor in list(self.cursors.items()):
+            if len(self.cursors) <= self.max_open and memory <= self.max_memory:
+                break
+            if cursor_id != keep:
+                evicted.append(self.cursors.pop(cursor_id))
+                memory -= cursor.memory
+        return evicted
+
+    def __close_cursors(self, cursors):
+        for cursor in cursors:
+            cursor.close()
+            cursor_logger.debug("Closed cursor: " + cursor.cursor_id)
+
+    def sweep(self):
+        with self.lock:
+            evicted = self.__evict()
+        self.__close_cursors(evicted)
+
+    # Background thread closing expired cursors
+    def start_sweeper(self, interval):
+        def sweeper():
+            while True:
+                time.sleep(interval)
+                self.sweep()
+        thread = threading.Thread(target=sweeper, name='cursor-sweeper', daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        with self.lock:
+            cursors = [cursor.info() for cursor in self.cursors.values()]
+        return {"open" : len(cursors),
+                "max_open" : self.max_open,
+                "ttl" : self.ttl,
+                "memory" : sum(cursor['memory'] for cursor in cursors),
+                "max_memory" : self.max_memory,
+                "cursors" : cursors}
@@ -0,0 +1,155 @@
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+import duckdb
+
+# Get the maestro logger
+pool_logger = logging.getLogger('maestro')
+
+# One pooled database
+# "database" (string with db filename)
+# "duck_conn" (duckdb connection object)
+# "lock" (serializes the use of duck_conn among threads)
+# "last_used" (monotonic time of the last checkin, for idle timeout)
+# "in_use" (number of cursors open on the connection, or being opened)
+class PoolEntry:
+    def __init__(self, database, duck_conn):
+        self.database = database
+        self.duck_conn = duck_conn
+        self.lock = threading.RLock()
+        self.last_used = time.monotonic()
+        self.in_use = 0
+
+# A cursor of a pooled database
+# Its entry counts as in use until the cursor is closed, so the connection is
+# never closed (idle timeout, eviction) under a cursor still in use
+# Everything but close goes to the duckdb cursor
+class PooledCursor:
+    def __init__(self, duck_cursor, checkin):
+        self.duck_cursor = duck_cursor
+        self.checkin = checkin
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.duck_cursor, name)
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        try:
+            self.duck_cursor.close()
+        finally:
+            self.checkin()
+
+    # A cursor nobody closed must not keep its database open forever
+    def __del__(self):
+        if 'closed' in self.__dict__:
+            self.close()
+
+class DuckPool:
+    def __init__(self, db_dir, max_open, idle_timeout, on_connect=None):
+        self.db_dir = db_dir
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        # Called with every new connection (e.g. to create functions)
+        self.on_connect = on_connect
+        # database -> PoolEntry, ordered from least to most recently used
+        self.entries = OrderedDict()
+        # Protects self.entries. Never held while a query runs
+        self.lock = threading.Lock()
+
+    # Return the entry of database, opening the connection if needed
+    # The caller gets the entry with in_use already incremented
+    def __checkout(self, database):
+        with self.lock:
+            entry = self.entries.get(database, None)
+            if entry != None:
+                # Warm connection, mark as most recently used
+                self.entries.move_to_end(database)
+                entry.in_use += 1
+                pool_logger.debug("Retrieved database connection: " + database)
+                return entry
+        # Open outside the pool lock, connecting may take a while
+        duck_conn = duckdb.connect(database=os.path.join(self.db_dir, database), read_only=False)
+        if self.on_connect:
+            self.on_connect(duck_conn)
+        with self.lock:
+            entry = self.entries.get(database, None)
+            if entry != None:
+                # Another thread opened it meanwhile, keep theirs
+                duck_conn.close()
+            else:
+                entry = PoolEntry(database, duck_conn)
+                self.entries[database] = entry
+                pool_logger.debug("Opened database connection: " + database)
+            self.entries.move_to_end(database)
+            entry.in_use += 1
+            evicted = self.__evict()
+        self.__close_entries(evicted)
+        return entry
+
+    def __checkin(self, entry):
+        with self.lock:
+            entry.in_use -= 1
+            entry.last_used = time.monotonic()
+
+    # Select entries to be closed. Must be called with self.lock held
+    # Entries in use are never evicted, so the pool may temporarily exceed max_open
+    def __evict(self):
+        evicted = []
+        now = time.monotonic()
+        # Idle timeout
+        for database, entry in list(self.entries.items()):
+            if entry.in_use == 0 and now - entry.last_used > self.idle_timeout:
+                evicted.append(self.entries.pop(database))
+        # Max open connections, least recently used first
+        for database, entry in list(self.entries.items()):
+            if len(self.entries) <= self.max_open:
+                break
+            if entry.in_use == 0:
+                evicted.append(self.entries.pop(database))
+        return evicted
+
+    def __close_entries(self, entries):
+        for entry in entries:
+            with entry.lock:
+                try:
+                    entry.duck_conn.close()
+                    pool_logger.debug("Closed database connection: " + entry.database)
+                except Exception as error:
+                    pool_logger.warning("Error closing database: " + str(error))
+
+    # Open an independent cursor (duckdb connection to the same database)
+    # The cursor is used on its own, e.g. for results fetched across requests
+    # It must be closed when done with it, the database stays open until then
+    def cursor(self, database):
+        entry = self.__checkout(database)
+        try:
+            with entry.lock:
+                duck_cursor = entry.duck_conn.cursor()
+        except Exception:
+            self.__checkin(entry)
+            raise
+        return PooledCursor(duck_cursor, lambda: self.__checkin(entry))
+
+    # Close idle connections. Called periodically and on every checkout
+    def sweep(self):
+        with self.lock:
+            evicted = self.__evict()
+        self.__close_entries(evicted)
+
+    # Background thread closing idle connections, so an idle database does not
+    # keep its file locked until the next request arrives
+    def start_sweeper(self, interval):
+        def sweeper():
+            while True:
+                time.sleep(interval)
+                self.sweep()
+        thread = threading.Thread(target=sweeper, name='duckpool-sweeper', daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,221 @@
+import os
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+import logging
+from metastore import metadata_mtime
+
+# Get the maestro logger
+watch_logger = logging.getLogger('maestro')
+
+# inotify constants (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT_HEADER = struct.Struct('iIII')
+
+# Changed directories from the kernel (Linux only)
+class InotifyBackend:
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify not available')
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # watch descriptor -> directory
+        self.watches = {}
+
+    def watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            watch_logger.debug("inotify_add_watch failed: " + path)
+            return
+        self.watches[wd] = path
+
+    # Wait up to timeout for events
+    # Returns (changed directories, new directories, overflow)
+    def poll(self, timeout):
+        changed = set()
+        created = set()
+        overflow = False
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed, created, overflow
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed, created, overflow
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            path = self.watches.get(wd, None)
+            if path == None:
+                continue
+            if mask & IN_IGNORED:
+                # The directory is gone, the kernel dropped the watch
+                del self.watches[wd]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                changed.add(path)
+                continue
+            changed.add(path)
+            if mask & IN_ISDIR and name:
+                sub_path = os.path.join(path, name)
+                changed.add(sub_path)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    created.add(sub_path)
+        return changed, created, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+# Changed directories from comparing directory mtimes, for other platforms
+# or when inotify is not available (e.g. NFS)
+class PollingBackend:
+    def __init__(self):
+        # directory -> mtime (ns), of its manifest if newer
+        self.watches = {}
+
+    def watch(self, path):
+        try:
+            self.watches[path] = metadata_mtime(path)
+        except OSError:
+            pass
+
+    def poll(self, timeout):
+        time.sleep(timeout)
+        changed = set()
+        created = set()
+        for path, mtime in list(self.watches.items()):
+            try:
+                new_mtime = metadata_mtime(path)
+            except OSError:
+                # The directory is gone
+                del self.watches[path]
+                changed.add(path)
+                continue
+            if new_mtime != mtime:
+                self.watches[path] = new_mtime
+                changed.add(path)
+                # New subdirectories must be watched too
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False) and entry.path not in self.watches:
+                            created.add(entry.path)
+                            changed.add(entry.path)
+        return changed, created, False
+
+    def close(self):
+        self.watches = {}
+
+# Background thread keeping the FileSet up to date with file_dir
+# Events are collected until nothing changes for "debounce" seconds, then the
+# changed directories are refreshed in one go
+class FileSetWatcher:
+    # register_meta: metadata for data files found without a metadata file
+    # (None leaves them unregistered)
+    def __init__(self, get_fset, debounce, poll_interval, checkpoint_interval,
+                 register_meta=None, use_inotify=True):
+        # Called on every refresh, the global FileSet may be replaced by a rebuild
+        self.get_fset = get_fset
+        self.register_meta = register_meta
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.backend = None
+        if use_inotify:
+            try:
+                self.backend = InotifyBackend()
+                watch_logger.debug("fset watcher using inotify")
+            except Exception as error:
+                watch_logger.warning("inotify not available, polling: " + str(error))
+        if self.backend == None:
+            self.backend = PollingBackend()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __watch_tree(self, paths):
+        for top in paths:
+            for path, directories, files in os.walk(top):
+                self.backend.watch(path)
+
+    def start(self):
+        self.__watch_tree(self.get_fset().tree)
+        self.thread = threading.Thread(target=self.run, name='fset-watcher', daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        pending = set()
+        overflow = False
+        first_event = 0
+        last_event = 0
+        last_checkpoint = time.monotonic()
+        while not self.stopped.is_set():
+            timeout = self.debounce if pending or overflow else self.poll_interval
+            try:
+                changed, created, lost = self.backend.poll(timeout)
+            except Exception as error:
+                watch_logger.warning("fset watcher error: " + str(error))
+                time.sleep(self.poll_interval)
+                continue
+            if created:
+                self.__watch_tree(created)
+            now = time.monotonic()
+            if changed or lost:
+                if not pending and not overflow:
+                    first_event = now
+                pending |= changed
+                overflow = overflow or lost
+                last_event = now
+            # Quiet for debounce seconds (or busy for too long), apply what we have
+            quiet = now - last_event >= self.debounce
+            waited = now - first_event >= self.debounce * 10
+            if (pending or overflow) and (quiet or waited):
+                try:
+                    # Fails while a rebuild replaces the FileSet, the changes are
+                    # applied on the next cycle
+                    fset = self.get_fset()
+                    if overflow:
+                        # Events were lost, reconcile everything by mtime
+                        fset.refresh()
+                        self.__watch_tree(fset.tree)
+                    else:
+                        fset.refresh_dirs(pending, self.register_meta)
+                except Exception as error:
+                    watch_logger.warning("fset watcher refresh error: " + str(error))
+                pending = set()
+                overflow = False
+            # Save the catalog from time to time, not on every change
+            if time.monotonic() - last_checkpoint >= self.checkpoint_interval:
+                try:
+                    self.get_fset().checkpoint()
+                    last_checkpoint = time.monotonic()
+                except Exception as error:
+                    watch_logger.warning("fset watcher checkpoint error: " + str(error))
+        self.backend.close()
@@ -0,0 +1,204 @@
+import uuid
+import logging
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Get the maestro logger
+ingest_logger = logging.getLogger('maestro')
+
+# Quoted DuckDB identifier
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+# DuckDB integer column types, widened to DOUBLE when fractional numbers come
+INTEGER_TYPES = ['TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT', 'HUGEINT',
+                 'UTINYINT', 'USMALLINT', 'UINTEGER', 'UBIGINT']
+
+# Append records (dicts) to a table of a DuckDB database, batch_size at a time
+# Each batch becomes an Arrow table inserted BY NAME; the table is created
+# from the first batch when it doesn't exist. The schema grows with the
+# batches: keys seen for the first time are added as columns (ALTER TABLE
+# ADD COLUMN), and columns only NULL so far take the type of the first
+# values found. Missing keys are NULL
+# JSON numbers mix integers and fractions: an integer column receiving
+# fractional numbers becomes DOUBLE (ALTER COLUMN). Any other change of type,
+# or a value the table column can't hold as is, is an error (ValueError)
+# With parquet_filename, the same batches are also written to a Parquet file
+# Everything happens in one transaction on duck_cursor
+class TableIngest:
+    def __init__(self, duck_cursor, table, batch_size, parquet_filename=None):
+        self.duck_cursor = duck_cursor
+        self.name = table
+        self.table = quote_identifier(table)
+        self.batch_size = batch_size
+        self.parquet_filename = parquet_filename
+        self.parquet_writer = None
+        self.schema = None
+        # DuckDB types of the schema fields
+        self.schema_types = {}
+        # Lowercase name -> type of the table columns, DuckDB names are case insensitive
+        self.columns = {}
+        # Columns added by us while their values were all NULL
+        self.null_columns = set()
+        self.rows = []
+        self.rows_ingested = 0
+        # Arrow table name, unique per ingestion
+        self.view = 'ingest_' + uuid.uuid4().hex
+        self.duck_cursor.execute("BEGIN TRANSACTION")
+
+    def append(self, register):
+        self.rows.append(register)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        batch = pa.Table.from_pylist(self.rows)
+        if self.schema == None:
+            self.__create(batch.schema)
+        elif batch.schema != self.schema:
+            self.__evolve(batch.schema)
+        if batch.schema != self.schema:
+            batch = pa.Table.from_pylist(self.rows, schema=self.schema)
+        self.duck_cursor.register(self.view, batch)
+        try:
+            self.__check_types()
+            self.duck_cursor.execute("INSERT INTO " + self.table + " BY NAME SELECT * FROM " + self.view)
+        finally:
+            self.duck_cursor.unregister(self.view)
+        if self.parquet_writer:
+            self.parquet_writer.write_table(batch)
+        self.rows_ingested += len(self.rows)
+        self.rows = []
+
+    def __create(self, schema):
+        self.__set_schema(schema)
+        existing = self.__table_columns()
+        self.duck_cursor.register(self.view, schema.empty_table())
+        self.duck_cursor.execute("CREATE TABLE IF NOT EXISTS " + self.table + " AS SELECT * FROM " + self.view)
+        self.duck_cursor.unregister(self.view)
+        self.columns = self.__table_columns()
+        if not existing:
+            self.null_columns = {field.name.lower() for field in schema if pa.types.is_null(field.type)}
+        self.__add_columns(schema)
+        if self.parquet_filename:
+            self.parquet_writer = pq.ParquetWriter(self.parquet_filename, self.schema)
+
+    # Merge the schema of a new batch into the table
+    def __evolve(self, batch_schema):
+        schema = self.__merge(batch_schema)
+        if schema == self.schema:
+            return
+        self.__add_columns(schema)
+        # Columns NULL so far get the type of their first values
+        promoted = [field for field in schema if field.name.lower() in self.null_columns
+                    and not pa.types.is_null(field.type)]
+        for field, column_type in zip(promoted, self.__duck_types(promoted)):
+            self.__alter_type(field.name, column_type)
+            self.null_columns.discard(field.name.lower())
+        if self.parquet_writer:
+            self.__rewrite_parquet(schema)
+        self.__set_schema(schema)
+
+    # Schema holding the records seen so far and batch_schema
+    # int64 and double make double, NULL takes the other type
+    def __merge(self, batch_schema):
+        fields = []
+        for field in self.schema:
+            index = batch_schema.get_field_index(field.name)
+            other = batch_schema.field(index) if index >= 0 else None
+            if other is None or other.type == field.type or pa.types.is_null(other.type):
+                fields.append(field)
+            elif pa.types.is_null(field.type):
+                fields.append(other)
+            elif {field.type, other.type} == {pa.int64(), pa.float64()}:
+                fields.append(pa.field(field.name, pa.float64()))
+            else:
+                raise ValueError("Column " + field.name + " of " + self.name + " changes type: " +
+                                 str(field.type) + " to " + str(other.type))
+        fields += [field for field in batch_schema if self.schema.get_field_index(field.name) < 0]
+        return pa.schema(fields)
+
+    # Values of the batch (registered as self.view) must fit the table
+    # columns as they are, INSERT BY NAME would cast them silently
+    def __check_types(self):
+        for name, batch_type in self.schema_types.items():
+            column_type = self.columns[name.lower()]
+            if batch_type == column_type:
+                continue
+            if batch_type == 'DOUBLE' and column_type in INTEGER_TYPES:
+                self.__alter_type(name, 'DOUBLE')
+                continue
+            column = quote_identifier(name)
+            # A value is lost when it doesn't cast, or (numbers) doesn't cast back the same
+            lost = column + " IS NOT NULL AND (TRY_CAST(" + column + " AS " + column_type + ") IS NULL"
+            if batch_type in INTEGER_TYPES + ['FLOAT', 'DOUBLE'] or batch_type.startswith('DECIMAL'):
+                lost += (" OR TRY_CAST(TRY_CAST(" + column + " AS " + column_type + ") AS " + batch_type +
+                         ") != " + column)
+            row = self.duck_cursor.execute("SELECT " + column + "::VARCHAR FROM " + self.view +
+                                           " WHERE " + lost + ") LIMIT 1").fetchone()
+            if row != None:
+                raise ValueError("Value " + str(row[0]) + " doesn't fit column " + name + " " +
+                                 column_type + " of " + self.name)
+
+    def __set_schema(self, schema):
+        self.schema = schema
+        fields = [field for field in schema if not pa.types.is_null(field.type)]
+        self.schema_types = dict(zip([field.name for field in fields], self.__duck_types(fields)))
+
+    def __alter_type(self, name, column_type):
+        self.duck_cursor.execute("ALTER TABLE " + self.table + " ALTER COLUMN " +
+                                 quote_identifier(name) + " TYPE " + column_type)
+        self.columns[name.lower()] = column_type
+
+    # Add the fields of schema the table doesn't have
+    def __add_columns(self, schema):
+        new_fields = [field for field in schema if field.name.lower() not in self.columns]
+        for field, column_type in zip(new_fields, self.__duck_types(new_fields)):
+            self.duck_cursor.execute("ALTER TABLE " + self.table + " ADD COLUMN " +
+                                     quote_identifier(field.name) + " " + column_type)
+            self.columns[field.name.lower()] = column_type
+            if pa.types.is_null(field.type):
+                self.null_columns.add(field.name.lower())
+
+    # DuckDB types of Arrow fields
+    def __duck_types(self, fields):
+        if not fields:
+            return []
+        self.duck_cursor.register(self.view, pa.schema(fields).empty_table())
+        column_types = [row[1] for row in self.duck_cursor.execute("DESCRIBE SELECT * FROM " + self.view).fetchall()]
+        self.duck_cursor.unregister(self.view)
+        return column_types
+
+    def __table_columns(self):
+        rows = self.duck_cursor.execute("SELECT column_name, data_type FROM information_schema.columns "
+                                        "WHERE table_name = ? AND table_schema = current_schema()",
+                                        [self.name]).fetchall()
+        return {row[0].lower() : row[1] for row in rows}
+
+    # A Parquet file has one schema, the batches written so far are written
+    # again with the new one. Schemas usually settle in the first batches
+    def __rewrite_parquet(self, schema):
+        self.parquet_writer.close()
+        written = pq.read_table(self.parquet_filename)
+        columns = [written.column(field.name).cast(field.type) if field.name in written.column_names
+                   else pa.nulls(len(written), field.type) for field in schema]
+        self.parquet_writer = pq.ParquetWriter(self.parquet_filename, schema)
+        self.parquet_writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+
+    # Commit, returns the number of rows ingested
+    def commit(self):
+        self.flush()
+        self.duck_cursor.execute("COMMIT")
+        if self.parquet_writer:
+            self.parquet_writer.close()
+        ingest_logger.debug("ingested rows: " + str(self.rows_ingested) + " into: " + self.table)
+        return self.rows_ingested
+
+    def rollback(self):
+        try:
+            self.duck_cursor.execute("ROLLBACK")
+        finally:
+            if self.parquet_writer:
+                self.parquet_writer.close()
@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+import logging
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import psutil
+
+# Get the maestro logger
+jobs_logger = logging.getLogger('maestro')
+
+JOB_DDL = '''CREATE TABLE IF NOT EXISTS transfer_job (
+    job_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    host TEXT,
+    status TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    submitted REAL NOT NULL,
+    started REAL,
+    ended REAL,
+    bytes_done INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT)'''
+
+# One background transfer
+# "work" is called with the job and returns the response dict of the transfer
+class TransferJob:
+    def __init__(self, kind, host, work):
+        self.job_id = str(uuid.uuid4())
+        self.kind = kind
+        self.host = host
+        self.work = work
+        self.status = 'queued'
+        self.submitted = time.time()
+        self.started = None
+        self.ended = None
+        self.bytes_done = 0
+        self.result = None
+        self.error = None
+        self.lock = threading.Lock()
+        # Called with the job to store its state, see JobQueue
+        self.save = None
+        self.saved = 0
+
+    # Progress callback, called with the number of bytes just transferred
+    # The byte count is stored at most every JobQueue.progress_interval
+    def progress(self, size):
+        with self.lock:
+            self.bytes_done += size
+        if self.save:
+            self.save(self, progress=True)
+
+    def row(self):
+        with self.lock:
+            bytes_done = self.bytes_done
+        return (self.job_id, self.kind, self.host, self.status, self.submitted, self.started, self.ended,
+                bytes_done, json.dumps(self.result) if self.result != None else None, self.error)
+
+# Response of a transfer_job row
+def job_info(row):
+    result = json.loads(row['result']) if row['result'] else None
+    rate = 0
+    if row['started']:
+        seconds = (row['ended'] or time.time()) - row['started']
+        if seconds > 0:
+            rate = int(row['bytes_done'] / seconds)
+    imported = []
+    if result != None:
+        imported = result.get('imported', result.get('files', []))
+    return {"job_id" : row['job_id'],
+            "kind" : row['kind'],
+            "host" : row['host'],
+            "status" : row['status'],
+            "submitted" : row['submitted'],
+            "started" : row['started'],
+            "ended" : row['ended'],
+            "bytes_done" : row['bytes_done'],
+            "rate" : rate,
+            "imported" : imported,
+            "result" : result,
+            "error" : row['error']}
+
+# Processes of this host only, others can't be checked from here
+def owner_alive(owner):
+    host, pid = owner.rsplit(':', 1)
+    if host != socket.gethostname():
+        return True
+    return psutil.pid_exists(int(pid))
+
+# Bounded pool of transfer workers
+# At most max_workers jobs run at once, and at most host_limits[host] (or
+# default_host_limit) against the same host. Jobs wait in FIFO order, a job
+# whose host is busy doesn't hold back jobs for other hosts
+# A job runs in the server process it was submitted to, and the limits are
+# per process. The state of every job is kept in a SQLite file (db_file), so
+# any server process (e.g. several workers) can answer polls. Jobs of a
+# process that is gone are reported as failed
+class JobQueue:
+    def __init__(self, db_file, max_workers, default_host_limit, host_limits=None, history=1000,
+                 progress_interval=1):
+        self.db_file = db_file
+        self.max_workers = max_workers
+        self.default_host_limit = default_host_limit
+        self.host_limits = host_limits or {}
+        self.history = history
+        self.progress_interval = progress_interval
+        self.owner = socket.gethostname() + ':' + str(os.getpid())
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='transfer')
+        # job_id -> TransferJob, of this process until they end
+        self.jobs = OrderedDict()
+        self.queue = deque()
+        self.running = 0
+        # host -> running jobs
+        self.host_running = {}
+        self.lock = threading.Lock()
+        with self.__connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(JOB_DDL)
+            conn.execute('CREATE INDEX IF NOT EXISTS transfer_job_submitted ON transfer_job (submitted)')
+
+    @contextmanager
+    def __connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    # Store the state of job
+    # progress: only the byte count changed, skipped if stored recently
+    def save(self, job, progress=False):
+        now = time.monotonic()
+        if progress and now - job.saved < self.progress_interval:
+            return
+        job.saved = now
+        try:
+            with self.__connect() as conn:
+                conn.execute('INSERT OR REPLACE INTO transfer_job (job_id, kind, host, status, submitted, started, '
+                             'ended, bytes_done, result, error, owner) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             job.row() + (self.owner,))
+        except sqlite3.Error as error:
+            jobs_logger.warning("Error saving transfer job: " + job.job_id + " error: " + str(error))
+
+    def submit(self, kind, host, work):
+        job = TransferJob(kind, host, work)
+        job.save = self.save
+        self.save(job)
+        with self.lock:
+            self.jobs[job.job_id] = job
+            self.queue.append(job)
+            self.__dispatch()
+        self.__forget()
+        jobs_logger.debug("transfer job queued: " + job.job_id + " " + kind + " " + str(host))
+        return job
+
+    # Response of the job, from any server process
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id, None)
+        if job != None:
+            # Ours, the latest byte count is in memory
+            self.save(job)
+        with self.__connect() as conn:
+            row = conn.execute('SELECT * FROM transfer_job WHERE job_id = ?', (job_id,)).fetchone()
+        if row == None:
+            return None
+        return job_info(self.__check_owner(row))
+
+    # The last history jobs, in submission order
+    def list(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            self.save(job)
+        with self.__connect() as conn:
+            rows = conn.execute('SELECT * FROM (SELECT * FROM transfer_job ORDER BY submitted DESC LIMIT ?) '
+                                'ORDER BY submitted', (self.history,)).fetchall()
+        return [job_info(self.__check_owner(row)) for row in rows]
+
+    # A job that didn't end, of a process that is gone, never will
+    def __check_owner(self, row):
+        if row['ended'] != None or row['owner'] == self.owner or owner_alive(row['owner']):
+            return row
+        row = dict(row)
+        row['status'] = 'failed'
+        row['error'] = 'server stopped: ' + row['owner']
+        row['ended'] = time.time()
+        with self.__connect() as conn:
+            conn.execute('UPDATE transfer_job SET status = ?, error = ?, ended = ? WHERE job_id = ? AND ended IS NULL',
+                         (row['status'], row['error'], row['ended'], row['job_id']))
+        return row
+
+    # Start queued jobs while there are free slots. Must be called with self.lock held
+    def __dispatch(self):
+        for job in list(self.queue):
+            if self.running >= self.max_workers:
+                break
+            limit = self.host_limits.get(job.host, self.default_host_limit)
+            if self.host_running.get(job.host, 0) >= limit:
+                continue
+            self.queue.remove(job)
+            self.running += 1
+            self.host_running[job.host] = self.host_running.get(job.host, 0) + 1
+            job.status = 'running'
+            job.started = time.time()
+            self.save(job)
+            self.executor.submit(self.__run, job)
+
+    def __run(self, job):
+        try:
+            job.result = job.work(job)
+            if job.result.get('error', None) != None:
+                job.status = 'failed'
+                job.error = job.result['error']
+            else:
+                job.status = 'done'
+        except Exception as error:
+            job.status = 'failed'
+            job.error = str(error)
+            jobs_logger.warning("transfer job failed: " + job.job_id + " error: " + str(error))
+        finally:
+            job.ended = time.time()
+            self.save(job)
+            with self.lock:
+                del self.jobs[job.job_id]
+                self.running -= 1
+                self.host_running[job.host] -= 1
+                if self.host_running[job.host] == 0:
+                    del self.host_running[job.host]
+                self.__dispatch()
+        jobs_logger.debug("transfer job " + job.status + ": " + job.job_id)
+
+    # Drop the oldest finished jobs above history
+    def __forget(self):
+        with self.__connect() as conn:
+            conn.execute('DELETE FROM transfer_job WHERE ended IS NOT NULL AND job_id NOT IN '
+                         '(SELECT job_id FROM transfer_job ORDER BY submitted DESC LIMIT ?)', (self.history,))
@@ -0,0 +1,57 @@
+import json
+import time
+import logging
+
+# Get the maestro logger
+tail_logger = logging.getLogger('maestro')
+
+# Log records (one JSON per line) written after offset
+# Only complete lines are returned, a line still being written is left for the
+# next call. At most max_bytes are read, everything with max_bytes=None
+# Returns the records and the offset to continue from
+def read_log(filename, offset=0, max_bytes=4 * 1024 * 1024):
+    try:
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            data = f.read(max_bytes)
+    except FileNotFoundError:
+        # The run didn't log anything yet
+        return [], offset
+    end = data.rfind(b'\n') + 1
+    if end == 0 and max_bytes != None and len(data) == max_bytes:
+        # A single line longer than max_bytes, return it anyway
+        end = len(data)
+    records = []
+    for line in data[:end].splitlines():
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            records.append({"event" : line.decode(errors='replace')})
+    return records, offset + end
+
+# Server-sent events with the log records, as they are written
+# Each event carries its offset as id, so a client reconnecting with
+# Last-Event-ID resumes where it stopped
+# running() tells whether more output may come. The stream ends when it
+# doesn't and everything was sent
+def log_events(filename, offset, running, poll_interval=1, heartbeat=15):
+    last_sent = time.monotonic()
+    while True:
+        # Check before reading, so output written just before the end is sent
+        active = running()
+        records, next_offset = read_log(filename, offset)
+        if records:
+            yield 'id: {}\ndata: {}\n\n'.format(next_offset, json.dumps(records))
+            last_sent = time.monotonic()
+        offset = next_offset
+        if not active and not records:
+            yield 'event: end\ndata: {}\n\n'.format(json.dumps({"offset" : offset}))
+            return
+        if time.monotonic() - last_sent > heartbeat:
+            # Keeps proxies from closing an idle connection
+            yield ': heartbeat\n\n'
+            last_sent = time.monotonic()
+        if not records:
+            time.sleep(poll_interval)
@@ -1,18 +1,31 @@
 import subprocess, os, psutil
 import uuid, yaml, json
-from flask import Flask, jsonify, request, send_from_directory
-import duckdb
+from flask import Flask, Response, jsonify, request, send_from_directory, stream_with_context
 from duckdb.typing import *
-from io import StringIO
 import paramiko
 import requests
 import re
 from requests.auth import HTTPBasicAuth
+from urllib.parse import urlparse
 import logging
-from zipfile import ZipFile
 from census_local import *
 from census_logging import * 
 from censusfs import FileSet
+from transfer import HttpDownload, DownloadError
+from jobs import JobQueue
+from unzip import extract_zip
+from sshpool import SSHPool, load_private_key, list_remote_files, get_remote_files, SyncManifest
+from fswatch import FileSetWatcher
+from metastore import SidecarWriter, ManifestWriter
+from duckpool import DuckPool
+from cursors import CursorRegistry
+from sqlstream import ndjson_stream, arrow_stream
+from ingest import TableIngest
+from uploads import UploadStore, UploadError
+from scheduler import ExtractorScheduler
+from logtail import read_log, log_events
+from qcache import QueryCache, result_table, result_columns
+from matview import MaterializedViews
 
 
 
@@ -24,71 +37,91 @@ def check_path_and_create(path):
 
 for path in [db_dir,
              log_dir,
+             sync_dir,
+             upload_tmp_dir,
              file_dir,
              upload_dir]:
     check_path_and_create(path)
 
 # Global Variables
 
-# List of opened connections
-# each connection has tuple with 
-# "database" (string with db filename)
-# "duck_conn" (duckdb connection object)
-# "result" (Relation Object from previous execution for future fetch)
-duck = []
+# Metadata writer, shared by every FileSet
+if METADATA_BACKEND == 'manifest':
+    metadata_writer = ManifestWriter(METADATA_FSYNC, MANIFEST_COMPACT_RATIO, MANIFEST_COMPACT_MIN_LINES)
+elif METADATA_BACKEND == 'sidecar':
+    metadata_writer = SidecarWriter(METADATA_FSYNC)
+else:
+    raise Exception('Unknown metadata backend: ' + str(METADATA_BACKEND))
 
 # Opened FileSet
-fset = FileSet(file_dir, {})
+fset = FileSet(file_dir, {}, catalog_file, writer=metadata_writer)
+
+# Keep fset up to date with changes under file_dir
+if FSET_WATCH:
+    fset_watcher = FileSetWatcher(lambda: fset,
+                                  FSET_WATCH_DEBOUNCE,
+                                  FSET_WATCH_POLL_INTERVAL,
+                                  FSET_WATCH_CHECKPOINT_INTERVAL,
+                                  register_meta=FSET_WATCH_REGISTER_META,
+                                  use_inotify=FSET_WATCH_INOTIFY)
+    fset_watcher.start()
 
 # DuckDB Functions
+# Queries with a filter get fset_list() bound to their own selection (a TEMP
+# macro on their cursor), queries without one select no files
 def fset_list():
-    global fset
-    return fset.filelist
-
-def get_duck_conn(database):
-    global duck
-    for db_name, duck_conn, result in duck:
-        if db_name == database:
-            # We have found, return the connection
-            app.logger.debug("Retrieved database connection: " + database)
-            return duck_conn, result
-    # If we haven't found, open a connection
-    try:
-        duck_conn = duckdb.connect(database=os.path.join(db_dir, database), read_only=False)
-        # Create the function
-        duck_conn.create_function('fset_list', fset_list, [], 'VARCHAR[]')        
-        # Add connection to online cache
-        duck.append((database, duck_conn, None))
-        app.logger.debug("Opened database connection: " + database)
-    except Exception as error:
-        app.logger.warning("Error opening database: " + error.args[0])
-        duck_conn = None
-    # return a recently created connection
-    return duck_conn, None    
-
-def close_duck_conn(database):
-    global duck
-    for db_name, duck_conn, result in duck:
-        if db_name == database:
-            # Remove from list
-            duck.remove((database, duck_conn, result))
-            # And close
-            duck_conn.close()
-            app.logger.debug("Closed database connection: " + database)
-            return
-    # We haven't found the connection
-    app.logger.warning("Error closing database, database not found: " + database )
-    return
-
-def update_duck_conn(database, new_result):
-    global duck
-    for db_name, duck_conn, result in duck:
-        if db_name == database:
-            # Remove onld tuple
-            duck.remove((database, duck_conn, result))
-            # Add the update
-            duck.append((database, duck_conn, new_result))
-    app.logger.debug("Updated database connection: " + database)
+    return []
+
+def create_duck_functions(duck_conn):
+    # Create the function
+    duck_conn.create_function('fset_list', fset_list, [], 'VARCHAR[]')
+
+# Pool of opened connections, one per database file
+duck_pool = DuckPool(db_dir, DUCK_POOL_MAX_OPEN, DUCK_POOL_IDLE_TIMEOUT,
+                     on_connect=create_duck_functions)
+duck_pool.start_sweeper(DUCK_POOL_IDLE_TIMEOUT)
+
+# Results of read-only queries run with cache=true
+query_cache = QueryCache(db_dir, QUERY_CACHE_MAX_BYTES,
+                         qcache_dir if QUERY_CACHE_SPILL_MAX_BYTES else None,
+                         QUERY_CACHE_SPILL_MAX_BYTES)
+
+# Queries over FileSet selections stored as tables
+materialized_views = MaterializedViews(duck_pool)
+
+# Server-side cursors of paginated results (fetchmany)
+sql_cursors = CursorRegistry(CURSOR_MAX_OPEN, CURSOR_TTL, CURSOR_MAX_MEMORY)
+sql_cursors.start_sweeper(CURSOR_TTL)
+
+# SSH sessions shared by the ssh transfers
+ssh_pool = SSHPool(SSH_IDLE_TIMEOUT, SSH_KEEPALIVE, SSH_WINDOW_SIZE)
+ssh_pool.start_sweeper(SSH_IDLE_TIMEOUT)
+
+# Background transfers (async=true on /transfer/http, /transfer/ssh/get and /files/import)
+transfer_jobs = JobQueue(transfer_db_file, TRANSFER_WORKERS, TRANSFER_DEFAULT_HOST_LIMIT,
+                         TRANSFER_HOST_LIMITS, TRANSFER_JOB_HISTORY)
+
+# Resumable uploads
+upload_sessions = UploadStore(upload_tmp_dir)
+upload_sessions.start_sweeper(UPLOAD_SESSION_TTL)
+
+# Meltano runs (/extractor)
+def launch_extractor(job):
+    return subprocess.Popen(['meltano',
+                             '--log-config=' + os.path.join(log_dir, job['exec_id'] + '.yaml'),
+                             'run',
+                             job['tap'],
+                             job['target']],
+                            #stdout=subprocess.PIPE,
+                            #stderr=subprocess.PIPE,
+                            universal_newlines=True,
+                            cwd=meltano_dir,
+                            # Own process group, cancel and timeout kill the plugins too
+                            start_new_session=True)
+
+extractor_jobs = ExtractorScheduler(extractor_db_file, EXTRACTOR_MAX_RUNNING, EXTRACTOR_TIMEOUT,
+                                    launch_extractor, EXTRACTOR_POLL_INTERVAL, stats_dir=log_dir)
+extractor_jobs.start()
 
 app = Flask(__name__)
 
@@ -105,49 +138,164 @@ def download_file(name):
         app.logger.debug("upload ERROR:" + error.args[1]) 
     
 
+# Resumable upload of a local file
+# POST /uploads/sessions {"meta", "size", "sha256"} opens the upload, size and
+# sha256 are optional. meta.local_path defaults to ['uploads']
+# PUT /uploads/sessions/<upload_id>?offset=n sends the bytes of a chunk as body
+# GET /uploads/sessions/<upload_id> tells the offset to resume from
+# POST /uploads/sessions/<upload_id>/complete {"sha256"} checks and registers the file
+# DELETE /uploads/sessions/<upload_id> drops the upload
+@app.route('/uploads/sessions', methods = ['POST'])
+def upload_create():
+    body = request.get_json()
+    meta = body.get('meta')
+    if not meta.get('local_path', None):
+        meta['local_path'] = ['uploads']
+    # The file is moved to local_path under file_dir on complete, refuse any
+    # path (absolute items, .., symlinks) that resolves outside of it
+    full_filename = os.path.realpath(os.path.join(file_dir, '/'.join(meta['local_path']), meta['filename']))
+    if (os.path.basename(meta['filename']) != meta['filename'] or
+            not full_filename.startswith(os.path.join(os.path.realpath(file_dir), ''))):
+        return jsonify({"error" : "Invalid filename: " + meta['filename']}), 400
+    session = upload_sessions.create(meta, body.get('size', None), body.get('sha256', None))
+    app.logger.debug("upload session:" + session.upload_id + " file:" + meta['filename'])
+    return jsonify(session.info())
+
+@app.route('/uploads/sessions/<upload_id>', methods = ['GET', 'PUT', 'DELETE'])
+def upload_chunk(upload_id):
+    session = upload_sessions.get(upload_id)
+    if session == None:
+        app.logger.warning("Couldn't find upload: " + upload_id)
+        return jsonify({"error" : "Couldn't find upload: " + upload_id})
+    if request.method == 'GET':
+        return jsonify(session.info())
+    if request.method == 'DELETE':
+        upload_sessions.abort(session)
+        return jsonify({"upload_id" : upload_id, "status" : "aborted"})
+    try:
+        offset = int(request.args.get('offset', session.received))
+        upload_sessions.write(session, offset, request.stream, CHUNK_SIZE)
+        resp = session.info()
+    except (UploadError, OSError, ValueError) as error:
+        resp = {"error" : str(error), "offset" : session.received}
+        app.logger.warning("error on upload: " + upload_id + " error: " + str(error))
+    return jsonify(resp)
+
+@app.route('/uploads/sessions/<upload_id>/complete', methods = ['POST'])
+def upload_complete(upload_id):
+    session = upload_sessions.get(upload_id)
+    if session == None:
+        app.logger.warning("Couldn't find upload: " + upload_id)
+        return jsonify({"error" : "Couldn't find upload: " + upload_id})
+    body = request.get_json(silent=True) or {}
+    meta = session.meta
+    local_path = '/'.join(meta['local_path'])
+    try:
+        os.makedirs(os.path.join(file_dir, local_path), exist_ok=True)
+        upload_sessions.complete(session, os.path.join(file_dir, local_path, meta['filename']),
+                                 body.get('sha256', None))
+        path, ext = os.path.splitext(meta['filename'])
+        imported = []
+        # Known file extensions
+        if ext in KNOWN_EXTENSIONS:
+            meta['type'] = ext.replace('.', '')
+            fset.new_file(meta, 'upload')
+            imported.append(meta['filename'])
+        resp = {"filename" : os.path.join(local_path, meta['filename']),
+                "imported" : imported}
+        app.logger.debug("upload complete:" + os.path.join(local_path, meta['filename']))
+    except (UploadError, OSError) as error:
+        resp = {"error" : str(error), "offset" : session.received}
+        app.logger.warning("error completing upload: " + upload_id + " error: " + str(error))
+    return jsonify(resp)
+
 @app.route("/filesystem/tree", methods = ['GET'])        
 def get_tree():
     global fset
     resp = {"tree" : fset.tree}
     return jsonify(resp)
 
+# Paging with ?offset=&limit=, ?fields=filename,path returns only those fields
 @app.route("/filesystem/files", methods = ['GET'])        
 def get_files():
     global fset
     body = request.get_json()
     file_filter = body.get('filter', None)
-    fset.get_files(file_filter)
-    resp = { "files" : fset.filelist_full }
+    offset = int(request.args.get('offset', 0))
+    limit = request.args.get('limit', None)
+    fields = request.args.get('fields', None)
+    try:
+        selection = fset.get_files(file_filter)
+        resp = { "files" : selection.rows(offset,
+                                          int(limit) if limit else None,
+                                          fields.split(',') if fields else None),
+                 "total" : len(selection) }
+    except Exception as error:
+        resp = {"error" : str(error)}
+        app.logger.warning("error selecting files: " + str(error))
     return jsonify(resp)
 
 
 @app.route("/filesystem/rebuild", methods = ['POST'])        
 def rebuild_fset():
     global fset
-    del fset
     body = request.get_json()
     file_filter = body.get('filter', None)
-    fset = FileSet(file_dir, file_filter)
+    # full=true ignores the catalog and reloads every directory
+    rebuild = request.args.get('full', 'false') == 'true'
+    # Requests and the watcher keep using the current FileSet until the new one is built
+    fset = FileSet(file_dir, file_filter, catalog_file, rebuild, metadata_writer)
     app.logger.debug("rebuild file system")
     resp = {"status" : "executed"}
     return jsonify(resp)
 
     
 
+# Transfers run in the request or, with async=true, as background jobs
+# polled on /transfer/jobs/<job_id>
+def run_transfer(kind, host, work):
+    if request.args.get('async', 'false') == 'true':
+        job = transfer_jobs.submit(kind, host, work)
+        return jsonify({"job_id" : job.job_id, "status" : job.status})
+    return jsonify(work(None))
+
+# Progress callback of job, if any
+def job_progress(job):
+    if job == None:
+        return None
+    return job.progress
+
+@app.route('/transfer/jobs', methods = ['GET'])
+def list_transfer_jobs():
+    return jsonify({"jobs" : transfer_jobs.list()})
+
+@app.route('/transfer/jobs/<job_id>', methods = ['GET'])
+def get_transfer_job(job_id):
+    info = transfer_jobs.get(job_id)
+    if info == None:
+        return jsonify({"error" : "Couldn't find transfer job: " + job_id})
+    return jsonify(info)
+
 @app.route('/transfer/http', methods = ['POST'])
 def get_http_file():
-        
     body = request.get_json()
     # If extract == true, unzip the file at the end
     extract = request.args.get('extract', 'false')
-    meta = body['meta']
-    local_path = '/'.join(meta['local_path'])
-    full_filename = os.path.join(file_dir, local_path, meta['filename'])
-    
     if extract == 'true':
         unzip = True
     else:
         unzip = False
+    if body.get("rest", {}).get("full_url", None):
+        host = urlparse(body['rest']['full_url']).hostname
+    else:
+        host = body['account']['host']
+    return run_transfer('http', host, lambda job: http_transfer(body, unzip, job))
+
+def http_transfer(body, unzip, job=None):
+    meta = body['meta']
+    local_path = '/'.join(meta['local_path'])
+    full_filename = os.path.join(file_dir, local_path, meta['filename'])
+
     # Headers
     headers = {}
     # Query Parameters
@@ -193,69 +341,80 @@ def get_http_file():
     else:
         auth = None
         
+    # Download engine, built on each try so a refreshed token is used
+    def download():
+        engine = HttpDownload(url, params=params, headers=headers, data=body_json, auth=auth,
+                              workers=DOWNLOAD_WORKERS,
+                              min_segment_size=DOWNLOAD_MIN_SEGMENT_SIZE,
+                              min_chunk_size=CHUNK_SIZE,
+                              max_chunk_size=DOWNLOAD_MAX_CHUNK_SIZE,
+                              retries=DOWNLOAD_RETRIES,
+                              progress=job_progress(job))
+        return engine.run(full_filename)
+
     # Response
     resp = {}
-    try:        
-        # read the file
-        stream = requests.get(url, params=params, headers=headers, data=body_json, auth=auth, stream=True)
-        # authentication failure and OAuth2
-        if stream.status_code == 401 and body['account']['auth'] == "oauth2":
-            app.logger.debug("OAuth Authentication Failure")
-            # refresh token
-            body['account']['oauth2']['access_token'] = refresh_access_token(body['account']['oauth2'])
-            app.logger.debug("OAuth Token Refreshed")
-            resp['new_token'] = body['account']['oauth2']['access_token']
-            insert_token()
-            # Try again 
-            stream = requests.get(url, params=params, headers=headers, data=body_json, auth=auth, stream=True)
-            app.logger.debug("Retry after OAuth Token Refreshed")
-                        
-        # Process only with 200 code
-        if stream.status_code == 200:
-            flist = []
-            with open(full_filename, 'wb') as fd:
-                for chunk in stream.iter_content(chunk_size=CHUNK_SIZE):
-                    fd.write(chunk)
-            # Add the main file
-            flist.append(meta['filename'])
-            resp["status"] = "transfered"
-            app.logger.debug("HTTP File Transfered Succeeded - Filename:" + full_filename)
-            if unzip:
-                with ZipFile(full_filename) as myzip:
-                    # Get all the filenames for metadata
-                    for file_info in myzip.filelist:
-                        flist.append(file_info.filename)
-                    myzip.extractall(path=os.path.join(file_dir,
-                                                        local_path))
-                app.logger.debug("File unzipped")
-            # Create metadata for each file
-            imported = []
-            for file in flist:
-                # Skip metadata files that start with .
-                if not file.startswith("."):
-                    # Overwrite filename with the filename of each file within the extraction
-                    meta['filename'] = file
-                    # We don't know the extension of the extracted files, get it!
-                    path, ext = os.path.splitext(file)
-                    # Known file extensions
-                    if ext in KNOWN_EXTENSIONS:
-                        meta['type'] = ext.replace('.', '')
-                        # Create
-                        fset.new_file(meta, 'http')
-                        # Update imported file list
-                        imported.append(file)
-
-            app.logger.debug("http files to:" + os.path.join(file_dir, local_path))
-            resp = { "imported" : imported}   
-                
-        else:
-            resp["error"] = stream.text
-            app.logger.warning("Error on HTTP File Request: " + stream.text)
+    try:
+        try:
+            # read the file
+            stats = download()
+        except DownloadError as error:
+            # authentication failure and OAuth2
+            if error.status_code == 401 and body['account']['auth'] == "oauth2":
+                app.logger.debug("OAuth Authentication Failure")
+                # refresh token
+                body['account']['oauth2']['access_token'] = refresh_access_token(body['account']['oauth2'])
+                app.logger.debug("OAuth Token Refreshed")
+                resp['new_token'] = body['account']['oauth2']['access_token']
+                insert_token()
+                # Try again
+                app.logger.debug("Retry after OAuth Token Refreshed")
+                stats = download()
+            else:
+                raise
+
+        flist = []
+        # Add the main file
+        flist.append(meta['filename'])
+        resp["status"] = "transfered"
+        app.logger.debug("HTTP File Transfered Succeeded - Filename:" + full_filename)
+        if unzip:
+            # Only members with a known extension are extracted
+            flist += extract_zip(full_filename, os.path.join(file_dir, local_path),
+                                 KNOWN_EXTENSIONS,
+                                 workers=UNZIP_WORKERS,
+                                 min_parallel_size=UNZIP_MIN_PARALLEL_SIZE)
+            app.logger.debug("File unzipped")
+        # Create metadata for each file
+        imported = []
+        metas = []
+        for file in flist:
+            # Skip metadata files that start with .
+            if not file.startswith("."):
+                # Overwrite filename with the filename of each file within the extraction
+                meta['filename'] = file
+                # We don't know the extension of the extracted files, get it!
+                path, ext = os.path.splitext(file)
+                # Known file extensions
+                if ext in KNOWN_EXTENSIONS:
+                    meta['type'] = ext.replace('.', '')
+                    # Create
+                    metas.append(dict(meta))
+                    # Update imported file list
+                    imported.append(file)
+        fset.new_files(metas, 'http')
+
+        app.logger.debug("http files to:" + os.path.join(file_dir, local_path))
+        resp["imported"] = imported
+        resp["transfer"] = stats
+    except DownloadError as error:
+        resp["error"] = error.text
+        app.logger.warning("Error on HTTP File Request: " + str(error.text))
     except Exception as error:
         resp["error"] = error.args
         app.logger.warning("Error :" + json.dumps(error.args))
     
-    return jsonify(resp)
+    return resp
             
 
 def refresh_access_token(oauth2):
@@ -280,6 +439,8 @@ def refresh_access_token(oauth2):
 #    "tap" : "tap-s3-csv",
 #    "target" : "target-duckdb"
 #}
+# The run is queued, it starts as soon as there is a free slot and no other
+# run of the same target. "timeout" (seconds) is optional
 @app.route('/extractor',methods = ['POST'])
 def go_process():
     body = request.get_json()
@@ -287,37 +448,63 @@ def go_process():
     target = body.get('target')
     #Get the output logfile
     exec_id = gen_log_config()
-    process = subprocess.Popen(['meltano',
-                                '--log-config=' + os.path.join(log_dir, exec_id + '.yaml'),
-                                'run', 
-                                tap, 
-                                target], 
-                               #stdout=subprocess.PIPE,
-                               #stderr=subprocess.PIPE,
-                               universal_newlines=True,
-                               #cwd=r'/Users/caio/Development/integra/data/dataops01')
-                               cwd=meltano_dir)
-
-    ended = process.poll()
-    if not ended:
-        msg = "running"
-    else:
-        
-        msg = "EXIT: " + str(ended)
-    return jsonify({"status":msg,
+    job = extractor_jobs.submit(exec_id, tap, target, body.get('timeout', None))
+    return jsonify({"status":job['status'],
                     "exec_id" : exec_id,
-                    "pid" : process.pid})
+                    "pid" : job['pid']})
 
+# Job table, newest first. ?status= filters, ?limit= (default 100)
+@app.route('/extractor/jobs',methods = ['GET'])
+def list_extractor_jobs():
+    status = request.args.get('status', None)
+    limit = int(request.args.get('limit', 100))
+    return jsonify(extractor_jobs.list(status, limit))
 
+@app.route('/extractor/jobs/<exec_id>',methods = ['GET', 'DELETE'])
+def extractor_job(exec_id):
+    if request.method == 'DELETE':
+        job = extractor_jobs.cancel(exec_id)
+    else:
+        job = extractor_jobs.get(exec_id)
+    if job == None:
+        app.logger.warning("Couldn't find extractor job: " + exec_id)
+        return jsonify({"error" : "Couldn't find extractor job: " + exec_id})
+    return jsonify(job)
+
+# Resource usage of the run: peak and average ("usage") and the samples ("series")
+@app.route('/extractor/jobs/<exec_id>/usage',methods = ['GET'])
+def extractor_usage(exec_id):
+    summary, series = extractor_jobs.usage(exec_id)
+    return jsonify({"exec_id" : exec_id,
+                    "usage" : summary,
+                    "series" : series})
+
+
+# Log of the run, whole, and the offset to ask from next time ("offset")
+# ?since=<offset> returns only the records written after offset, at most
+# LOG_TAIL_MAX_BYTES of them, ask again from "offset" for the rest
+# ?stream=sse pushes the records as server-sent events until the run ends
 @app.route('/extractor/<exec_id>',methods = ['GET'])
 def get_extractor_log(exec_id):
+    log_filename = os.path.join(log_dir, exec_id + '.log')
+    offset = request.args.get('since', request.headers.get('Last-Event-ID', '0'))
+    try:
+        since = int(offset)
+    except ValueError:
+        since = -1
+    if since < 0:
+        return jsonify({"error" : "Invalid offset: " + offset}), 400
+    if request.args.get('stream', None) == 'sse':
+        def running():
+            job = extractor_jobs.get(exec_id)
+            return job != None and job['status'] in ('queued', 'running')
+        return Response(stream_with_context(log_events(log_filename, since, running,
+                                                       LOG_TAIL_POLL_INTERVAL)),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control' : 'no-cache'})
     resp = {}
-    with open(os.path.join(log_dir, exec_id + '.log')) as f:
-        lines = f.readlines()
-        json_log = []
-        for line in lines:
-            json_log.append(json.loads(line))
-    resp['log'] = json_log
+    max_bytes = LOG_TAIL_MAX_BYTES if 'since' in request.args else None
+    resp['log'], resp['offset'] = read_log(log_filename, since, max_bytes)
     pid = request.args.get('pid', None)
     if pid: 
         if psutil.pid_exists(int(pid)):
@@ -326,6 +513,10 @@ def get_extractor_log(exec_id):
         else:
             status = 'not found'
         resp['status'] = status
+    # Peak and average resource usage, once the run ended
+    job = extractor_jobs.get(exec_id)
+    if job != None and job['usage']:
+        resp['usage'] = job['usage']
     
     return jsonify(resp)
 
@@ -334,97 +525,258 @@ def sql_execute(database):
     body = request.get_json()
     query = body.get('query')
     file_filter = body.get('filter', None)
+    selection = None
     if file_filter:
-        # Update fset
-        fset.get_files(file_filter)
-    duck_conn, result = get_duck_conn(database)
-    if duck_conn != None:
-        # We have a database
+        # Files of this request, fset_list() returns them
         try:
-            result =  duck_conn.sql(query)
+            selection = fset.get_files(file_filter)
         except Exception as error:
-            resp = {"error" : error.args[0]}
-            app.logger.warning("error executed sql: " + query + " error: " + error.args[0])                
-            close_duck_conn(database)
-            return jsonify(resp)
-
-        if file_filter:
-            # Update metadata
-            meta_update = { 'processed' : True }
-            fset.update_file(meta_update, file_filter['user'])
+            app.logger.warning("error selecting files: " + str(error))
+            return jsonify({"error" : str(error)})
+    fetchmany = request.args.get('fetchmany', None)
+    if fetchmany:
+        # Paginated result, served from a server-side cursor
+        return sql_execute_cursor(database, query, selection, int(fetchmany))
+    output_format = request.args.get('format', None)
+    if request.args.get('stream', None) == 'ndjson' or output_format == 'arrow':
+        # Chunked response, rows are sent as they are fetched
+        return sql_execute_stream(database, query, selection, output_format)
+    if output_format == 'parquet':
+        # Result written to a file available on /uploads/<name>
+        return sql_execute_parquet(database, query, selection)
+    # Cached result, for queries that only read
+    cache_key = None
+    if request.args.get('cache', 'false') == 'true':
+        fset_version = selection.version if selection else fset.version
+        cache_key = query_cache.key(database, query, file_filter, fset_version)
+        if cache_key:
+            table = query_cache.get(cache_key, fset_version)
+            if table != None:
+                app.logger.debug("executed sql cached: " + query)
+                return jsonify(table_response(table, request.args.get('format', False)))
+    duck_cursor, result, resp = execute_on_cursor(database, query, selection)
+    if resp != None:
+        return jsonify(resp)
+    try:
         # Deal with DuckDB Relation
-        if result != None:
-            fetchmany = request.args.get('fetchmany', None)
-            if fetchmany:
-                resp = result.fetchmany(int(fetchmany))
-                app.logger.debug("executed sql fetch: " + query + " fetchmany: " + fetchmany)
-                if len(resp) < int(fetchmany):
-                    # Close connection if we have read it all
-                    close_duck_conn(database)
-                else:
-                    # Update connection with new result for future fetch
-                    update_duck_conn(database, result)
-            else:
-                resp = result.fetchall()
-                app.logger.debug("executed sql all: " + query)    
-                close_duck_conn(database)
+        if cache_key:
+            table = result_table(result)
+            # Not if the selection changed meanwhile (e.g. files just marked processed)
+            if fset.version == fset_version:
+                query_cache.put(cache_key, database, fset_version, table)
+            resp = table_response(table, request.args.get('format', False))
+        else:
+            resp = result.fetchall()
             # Return as a list of records - JSON
             if request.args.get('format', False) == 'list_of_records':
                 resp = json_response(result, resp)
-        # No response to deal with
-        else:
-            resp = { "status" : "executed"}
-            app.logger.debug("executed sql: " + query)
-            # Not fetchmany, so close the connection
-            close_duck_conn(database)
-    # We don't have a database
-    else:
-        resp = {"error" : "Couldn't open database: " + database}
-        app.logger.warning("Couldn't open database: " + database)    
+        app.logger.debug("executed sql all: " + query)
+    except Exception as error:
+        resp = {"error" : str(error)}
+        app.logger.warning("error executed sql: " + query + " error: " + str(error))
+    finally:
+        duck_cursor.close()
     return jsonify(resp)
 
-@app.route('/sql/fetch/<database>', methods = ['POST'])
-def fetch(database):
-    duck_conn, result = get_duck_conn(database)
+# Execute the query on its own cursor, with fset_list() bound to selection
+# Queries of different requests run side by side, each one sees its own files
+# Returns the cursor and the result, or the error response
+def execute_on_cursor(database, query, selection):
+    try:
+        duck_cursor = duck_pool.cursor(database)
+    except Exception as error:
+        # We don't have a database
+        app.logger.warning("Couldn't open database: " + database + " error: " + str(error))
+        return None, None, {"error" : "Couldn't open database: " + database}
+    try:
+        if selection:
+            selection.bind(duck_cursor)
+        result = duck_cursor.sql(query)
+    except Exception as error:
+        app.logger.warning("error executed sql: " + query + " error: " + error.args[0])
+        duck_cursor.close()
+        return None, None, {"error" : error.args[0]}
+
+    if selection:
+        # Update metadata
+        meta_update = { 'processed' : True }
+        fset.update_files(selection, meta_update, selection.filter.user)
+    # No response to deal with
+    if result == None:
+        duck_cursor.close()
+        # It may have written to the database
+        query_cache.invalidate(database)
+        app.logger.debug("executed sql: " + query)
+        return None, None, { "status" : "executed"}
+    return duck_cursor, result, None
+
+# Execute the query and return the first fetchmany rows
+# The response carries the cursor_id for the following /sql/fetch calls
+def sql_execute_cursor(database, query, selection, fetchmany):
+    duck_cursor, result, resp = execute_on_cursor(database, query, selection)
+    if resp != None:
+        return jsonify(resp)
+    cursor = sql_cursors.open(database, query, duck_cursor, result)
+    return cursor_response(cursor, fetchmany)
+
+# Execute the query and stream the result as chunks of NDJSON or Arrow IPC
+def sql_execute_stream(database, query, selection, output_format):
+    duck_cursor, result, resp = execute_on_cursor(database, query, selection)
+    if resp != None:
+        return jsonify(resp)
+    app.logger.debug("executed sql stream: " + query)
+    if output_format == 'arrow':
+        return Response(stream_with_context(arrow_stream(duck_cursor, result, STREAM_BATCH_SIZE)),
+                        mimetype='application/vnd.apache.arrow.stream')
+    return Response(stream_with_context(ndjson_stream(duck_cursor, result, STREAM_BATCH_SIZE)),
+                    mimetype='application/x-ndjson')
+
+# Execute the query and write the result as a parquet file into upload_dir
+def sql_execute_parquet(database, query, selection):
+    duck_cursor, result, resp = execute_on_cursor(database, query, selection)
+    if resp != None:
+        return jsonify(resp)
+    filename = str(uuid.uuid4()) + '.parquet'
+    try:
+        result.write_parquet(os.path.join(upload_dir, filename))
+        resp = {"filename" : filename,
+                "url" : "/uploads/" + filename}
+        app.logger.debug("executed sql parquet: " + query + " file: " + filename)
+    except Exception as error:
+        resp = {"error" : error.args[0]}
+        app.logger.warning("error writing parquet: " + query + " error: " + error.args[0])
+    finally:
+        duck_cursor.close()
+    return jsonify(resp)
+
+@app.route('/sql/fetch/<cursor_id>', methods = ['POST'])
+def fetch(cursor_id):
     fetchmany = request.args.get('fetchmany', None)
-    if result != None :       
-        try:
-            if fetchmany:
-                resp = result.fetchmany(int(fetchmany))
-                app.logger.debug("executed fetchmany: " + fetchmany)
-                # Close connection if we reached the end of Relation Object
-                if len(resp) < int(fetchmany):
-                    close_duck_conn(database)
-                else:
-                    update_duck_conn(database, result)
-            else:
-                resp = result.fetchall()
-                app.logger.debug("executed fetchall ")
-                close_duck_conn(database)
-            if request.args.get('format', False) == 'list_of_records':
-                resp = json_response(result, resp)
-                
-        except Exception as error:
-            resp = {"error" : error.args[1]}
+    cursor = sql_cursors.get(cursor_id)
+    if cursor == None:
+        resp = {"error" : "Couldn't find cursor for fetch: " + cursor_id}
+        app.logger.warning("Couldn't find cursor for fetch: " + cursor_id)
+        return jsonify(resp)
+    return cursor_response(cursor, int(fetchmany) if fetchmany else CURSOR_FETCH_SIZE)
+
+# Fetch the next rows of cursor
+def cursor_response(cursor, fetchmany):
+    try:
+        rows = sql_cursors.fetch(cursor, fetchmany)
+    except Exception as error:
+        sql_cursors.close(cursor.cursor_id)
+        resp = {"error" : error.args[0]}
+        app.logger.warning("error fetching cursor: " + cursor.cursor_id + " error: " + error.args[0])
+        return jsonify(resp)
+    app.logger.debug("executed fetchmany: " + str(fetchmany) + " cursor: " + cursor.cursor_id)
+    # Return as a list of records - JSON
+    if request.args.get('format', False) == 'list_of_records':
+        rows = [dict(zip(cursor.columns, register)) for register in rows]
+    resp = {"cursor_id" : cursor.cursor_id,
+            "done" : cursor.done,
+            "data" : rows}
+    return jsonify(resp)
+
+@app.route('/sql/cursor/<cursor_id>', methods = ['DELETE'])
+def close_cursor(cursor_id):
+    if sql_cursors.close(cursor_id):
+        resp = {"status" : "closed"}
     else:
-        resp = {"error" : "Couldn't find result for fetch"}
-        app.logger.warning("Couldn't find result for fetch")    
-        close_duck_conn(database)
+        resp = {"error" : "Couldn't find cursor: " + cursor_id}
     return jsonify(resp)
 
+@app.route('/sql/cursors', methods = ['GET'])
+def list_cursors():
+    return jsonify(sql_cursors.stats())
+
 def json_response(result, resp):
     columns = result.columns
     new_resp =  [dict(zip(columns,register)) for register in resp]
     return new_resp
+
+# Response of a cached result, the same as from the relation
+def table_response(table, output_format):
+    resp = query_cache.fetchall(table)
+    if output_format == 'list_of_records':
+        columns = result_columns(table)
+        resp = [dict(zip(columns, register)) for register in resp]
+    return resp
+
+# Full filenames of the files selected by file_filter
+def fset_selection(file_filter):
+    return list(fset.get_files(file_filter).filelist)
+
+# Materialized views: a query over fset_list() stored as a table
+# POST {"name", "query", "filter"} creates the view, loaded with the files
+# selected by filter. Query it as a regular table
+@app.route('/sql/matview/<database>', methods = ['GET', 'POST'])
+def matviews(database):
+    try:
+        if request.method == 'GET':
+            return jsonify(materialized_views.list(database))
+        body = request.get_json()
+        files = fset_selection(body.get('filter'))
+        resp = materialized_views.create(database, body.get('name'), body.get('query'),
+                                         body.get('filter'), files)
+        query_cache.invalidate(database)
+        app.logger.debug("materialized view created: " + database + "." + body.get('name'))
+    except Exception as error:
+        resp = {"error" : str(error)}
+        app.logger.warning("error on materialized view: " + database + " error: " + str(error))
+    return jsonify(resp)
+
+# Append the files selected since the last refresh. ?full=true reloads everything
+@app.route('/sql/matview/<database>/<name>', methods = ['GET', 'POST', 'DELETE'])
+def matview(database, name):
+    try:
+        if request.method == 'GET':
+            resp = materialized_views.get(database, name)
+            if resp == None:
+                resp = {"error" : "Couldn't find materialized view: " + name}
+        elif request.method == 'DELETE':
+            materialized_views.drop(database, name)
+            query_cache.invalidate(database)
+            resp = {"name" : name, "status" : "dropped"}
+        else:
+            view = materialized_views.get(database, name)
+            if view == None:
+                return jsonify({"error" : "Couldn't find materialized view: " + name})
+            files = fset_selection(view['filter'])
+            resp = materialized_views.refresh(database, name, files,
+                                              full=request.args.get('full', 'false') == 'true')
+            query_cache.invalidate(database)
+    except Exception as error:
+        resp = {"error" : str(error)}
+        app.logger.warning("error on materialized view: " + database + "." + name + " error: " + str(error))
+    return jsonify(resp)
+
+@app.route('/sql/cache', methods = ['GET'])
+def sql_cache():
+    return jsonify(query_cache.stats())
     
 
 # Saves the json_data into the filename
 # filename = Name of the file to store the json data
 # json_data = Array of records to be imported into duckdb
+# With "database" and "table", json_data is inserted into the table instead,
+# and saved as Parquet into the filename only if "format" == "parquet"
+# A body of type application/x-ndjson (one record per line) is ingested as it
+# is received: ?database=&table= and, to save it as Parquet, ?meta=<json>
 @app.route('/transfer/json', methods = ['POST'])
 def receive_json():
     global fset
+    if request.mimetype == 'application/x-ndjson':
+        meta = request.args.get('meta', None)
+        records = (json.loads(line) for line in request.stream if line.strip())
+        return jsonify(ingest_records(request.args.get('database'),
+                                      request.args.get('table'),
+                                      json.loads(meta) if meta else None,
+                                      records))
     body = request.get_json()
+    if body.get('table', None):
+        meta = body.get('meta') if body.get('format', None) == 'parquet' else None
+        return jsonify(ingest_records(body.get('database'), body.get('table'), meta,
+                                      body.get('json_data')))
     json_data = body.get('json_data')
     meta = body.get('meta')
     local_path = '/'.join(meta['local_path'])
@@ -442,6 +794,44 @@ def receive_json():
         app.logger.warning("error saving json:" + meta['filename'] + " error:" + error.args)
     return jsonify(resp)
 
+# Insert records into table of database, in batches
+# With meta, the records are also saved as a Parquet file and registered
+def ingest_records(database, table, meta, records):
+    parquet_filename = None
+    if meta:
+        local_path = '/'.join(meta['local_path'])
+        parquet_filename = os.path.join(file_dir, local_path, meta['filename'])
+    try:
+        duck_cursor = duck_pool.cursor(database)
+    except Exception as error:
+        # We don't have a database
+        app.logger.warning("Couldn't open database: " + database + " error: " + str(error))
+        return {"error" : "Couldn't open database: " + database}
+    try:
+        ingest = TableIngest(duck_cursor, table, INGEST_BATCH_SIZE, parquet_filename)
+        try:
+            for register in records:
+                ingest.append(register)
+            rows = ingest.commit()
+        except Exception:
+            ingest.rollback()
+            if parquet_filename and os.path.exists(parquet_filename):
+                os.remove(parquet_filename)
+            raise
+        resp = {"table" : table, "rows" : rows}
+        if meta:
+            # Create the meta file
+            meta['type'] = 'parquet'
+            fset.new_file(meta, 'json')
+            resp["filename"] = os.path.join(local_path, meta['filename'])
+        app.logger.debug("ingested json:" + database + "." + table + " rows:" + str(rows))
+    except Exception as error:
+        resp = {"error" : str(error)}
+        app.logger.warning("error ingesting json:" + database + "." + table + " error:" + str(error))
+    finally:
+        duck_cursor.close()
+    return resp
+
 #List files directory - Only files
 @app.route('/files/list', methods = ['GET'])
 def list_files():
@@ -460,9 +850,12 @@ def list_files():
 #Import files directory
 @app.route('/files/import', methods = ['POST'])
 def import_files():
-    global fset
     body = request.get_json()
     meta = body.get('meta')
+    return run_transfer('import', 'local', lambda job: import_directory(meta))
+
+def import_directory(meta):
+    global fset
     subdir = '/'.join(meta['local_path'])
     imported = []
     # Get the file list
@@ -470,9 +863,10 @@ def import_files():
         files = [f for f in os.listdir(os.path.join(file_dir, subdir)) if os.path.isfile(os.path.join(os.path.join(file_dir, subdir), f))]
     except Exception as error:
         resp = {"error" : error.args[1]}
-        return jsonify(resp)
+        return resp
     
     # Create metadata for each file
+    metas = []
     for file in files:
         # Remove metadata files
         if not file.startswith("."):                
@@ -482,13 +876,14 @@ def import_files():
             if ext in KNOWN_EXTENSIONS:
                 meta['type'] = ext.replace('.', '')
             # Create
-            fset.new_file(meta, 'import')
+            metas.append(dict(meta))
             # Update imported file list
             imported.append(file)
-        
+    fset.new_files(metas, 'import')
+
     app.logger.debug("imported files in:" + os.path.join(file_dir, subdir))
-    resp = { "imported" : imported}   
-    return jsonify(resp)
+    resp = { "imported" : imported}
+    return resp
 
 #List files directory - Only files
 @app.route('/logger_level', methods = ['POST'])
@@ -513,62 +908,107 @@ def list_remote_directory():
     server = body.get('server')
     port = body.get('port')
     directory = body.get('directory')
-    #create a virtual file
-    not_really_a_file = StringIO(private_key)
-    # import as paramiko key
-    p_key = paramiko.RSAKey.from_private_key(not_really_a_file)
-    transport = paramiko.Transport((server,int(port)))
-    transport.connect(username=username, pkey=p_key)
-    sftp = paramiko.SFTPClient.from_transport(transport)
-    # Get the list
-    resp = sftp.listdir(path=directory)
-    
+    p_key = load_private_key(private_key)
+    session = ssh_pool.acquire(server, port, username, p_key)
+    try:
+        sftp = paramiko.SFTPClient.from_transport(session.transport)
+        # Get the list
+        resp = sftp.listdir(path=directory)
+        sftp.close()
+    finally:
+        ssh_pool.release(session)
+
     return jsonify(resp)
-    
+
 @app.route('/transfer/ssh/get', methods = ['POST'])
 def get_remote_ssh():
     body = request.get_json()
+    return run_transfer('ssh', body.get('server'), lambda job: ssh_transfer(body, job))
+
+# sync=true only fetches files that are new or changed (size, mtime) since
+# the previous sync into the same local directory
+# With "meta", files go to file_dir/meta.local_path and are registered in
+# the FileSet with origin 'ssh'. Otherwise they go to "local_path"
+def ssh_transfer(body, job=None):
     private_key = body.get('private_key')
     username = body.get('username')
     server = body.get('server')
     port = body.get('port')
     remote_path = body.get('remote_path')
     search_pattern = body.get('search_pattern')
-    local_path = body.get('local_path')
-    #create a virtual file
-    not_really_a_file = StringIO(private_key)
-    # import as paramiko key
-    p_key = paramiko.RSAKey.from_private_key(not_really_a_file)
-    
-    #Get the list of files to be moves
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(server, username=username, pkey=p_key)  
-    rawcommand = 'find {path} -maxdepth 1 -name "{pattern}"'
-    command = rawcommand.format(path=remote_path, pattern=search_pattern)
-    stdin, stdout, stderr = ssh.exec_command(command)
-    filelist = stdout.read().splitlines()
-    ssh.close()
-    
-    
-    #Move the files
-    transport = paramiko.Transport((server,int(port)))
-    transport.connect(username=username, pkey=p_key)
+    meta = body.get('meta', None)
+    if meta:
+        local_path = os.path.join(file_dir, '/'.join(meta['local_path']))
+    else:
+        local_path = body.get('local_path')
+    sync = body.get('sync', False)
+    p_key = load_private_key(private_key)
+
+    # Listing and transfer share one pooled session
     files_moved = []
     try:
-        sftp = paramiko.SFTPClient.from_transport(transport)
-        #Iterate over the file list
-        for afile in filelist:
-            (head, filename) = os.path.split(afile)
-            files_moved.append(filename.decode())
-            
-            # Move File
-            sftp.get(afile, os.path.join(local_path, filename.decode()))
+        session = ssh_pool.acquire(server, port, username, p_key)
+    except Exception as error:
+        return {"status":"error","error" : str(error)}
+    try:
+        #Get the list of files to be moved
+        sftp = paramiko.SFTPClient.from_transport(session.transport)
+        try:
+            filelist = list_remote_files(sftp, remote_path, search_pattern)
+        finally:
+            sftp.close()
+        listed = len(filelist)
+        if sync:
+            manifest = SyncManifest(sync_dir, server, port, username, remote_path, local_path)
+            filelist = manifest.changed(filelist)
+        transfers = []
+        for attr in filelist:
+            files_moved.append(attr.filename)
+            transfers.append((remote_path.rstrip('/') + '/' + attr.filename,
+                              os.path.join(local_path, attr.filename)))
+        #Move the files, in parallel over several channels
+        get_remote_files(session.transport, transfers, SSH_CHANNELS, callback=sftp_progress(job))
+        # Keep the remote mtime, the local file is a copy of that version
+        for attr, (remote_filename, local_filename) in zip(filelist, transfers):
+            os.utime(local_filename, (attr.st_atime or attr.st_mtime, attr.st_mtime))
+        if sync:
+            manifest.update(filelist)
+            manifest.save()
         resp = {"status" : "success", "files" : files_moved}
+        if sync:
+            resp["skipped"] = listed - len(filelist)
+        if meta:
+            resp["imported"] = ssh_register(meta, files_moved)
     except Exception as error:
-        resp = {"status":"error","error" : error.args[1]}
+        resp = {"status":"error","error" : str(error)}
+    finally:
+        ssh_pool.release(session)
 
-    return jsonify(resp)
+    return resp
+
+# Register the fetched files in the FileSet
+def ssh_register(meta, files):
+    metas = []
+    imported = []
+    for file in files:
+        path, ext = os.path.splitext(file)
+        # Known file extensions
+        if ext in KNOWN_EXTENSIONS:
+            file_meta = dict(meta)
+            file_meta['filename'] = file
+            file_meta['type'] = ext.replace('.', '')
+            metas.append(file_meta)
+            imported.append(file)
+    fset.new_files(metas, 'ssh')
+    return imported
+
+# get_files callback reporting the progress to job
+def sftp_progress(job):
+    if job == None:
+        return None
+    def callback(local_filename, size):
+        job.progress(size)
+    return callback
 
 def gen_log_config():
     with open(meltano_log_config_file) as f:
@@ -0,0 +1,152 @@
+import json
+import datetime
+import threading
+import logging
+import pyarrow as pa
+from ingest import quote_identifier
+from censusfs import bind_fset_list
+
+# Get the maestro logger
+matview_logger = logging.getLogger('maestro')
+
+# Definitions of the materialized views of a database
+MATVIEW_DDL = '''CREATE TABLE IF NOT EXISTS census_matview (
+    name VARCHAR PRIMARY KEY,
+    query VARCHAR,
+    filter VARCHAR,
+    created TIMESTAMP,
+    refreshed TIMESTAMP,
+    files BIGINT)'''
+
+# Files already in each view
+MATVIEW_FILES_DDL = '''CREATE TABLE IF NOT EXISTS census_matview_files (
+    view VARCHAR,
+    filename VARCHAR,
+    refreshed TIMESTAMP)'''
+
+# A query over a FileSet selection (fset_list()), stored as a table of the
+# database. The files that went into the table are recorded, a refresh runs
+# the query over the new files only and appends the result
+# Files changed or removed after they were loaded are not taken out, a full
+# refresh rebuilds the table from the current selection
+class MaterializedViews:
+    def __init__(self, duck_pool):
+        self.duck_pool = duck_pool
+        # (database, name) -> lock, one refresh of a view at a time
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def __view_lock(self, database, name):
+        with self.lock:
+            return self.locks.setdefault((database, name), threading.Lock())
+
+    def __cursor(self, database):
+        duck_cursor = self.duck_pool.cursor(database)
+        duck_cursor.execute(MATVIEW_DDL)
+        duck_cursor.execute(MATVIEW_FILES_DDL)
+        return duck_cursor
+
+    def __get(self, duck_cursor, name):
+        view = duck_cursor.execute("SELECT * FROM census_matview WHERE name = $name", {'name' : name})
+        columns = [column[0] for column in view.description]
+        register = view.fetchone()
+        if register == None:
+            return None
+        view = dict(zip(columns, register))
+        view['filter'] = json.loads(view['filter'])
+        return view
+
+    def list(self, database):
+        duck_cursor = self.__cursor(database)
+        try:
+            names = duck_cursor.execute("SELECT name FROM census_matview ORDER BY name").fetchall()
+            return [self.__get(duck_cursor, register[0]) for register in names]
+        finally:
+            duck_cursor.close()
+
+    def get(self, database, name):
+        duck_cursor = self.__cursor(database)
+        try:
+            return self.__get(duck_cursor, name)
+        finally:
+            duck_cursor.close()
+
+    # Define the view and load it with files
+    def create(self, database, name, query, file_filter, files):
+        duck_cursor = self.__cursor(database)
+        try:
+            if self.__get(duck_cursor, name) != None:
+                raise Exception('Materialized view already exists: ' + name)
+            now = datetime.datetime.utcnow()
+            duck_cursor.execute("INSERT INTO census_matview VALUES ($name, $query, $filter, $now, NULL, 0)",
+                                {'name' : name, 'query' : query, 'filter' : json.dumps(file_filter), 'now' : now})
+        finally:
+            duck_cursor.close()
+        try:
+            return self.refresh(database, name, files)
+        except Exception:
+            self.drop(database, name)
+            raise
+
+    # Append the result of the query over the files not in the view yet
+    # files: current selection of the view's filter
+    # full: drop everything and load all files again
+    def refresh(self, database, name, files, full=False):
+        with self.__view_lock(database, name):
+            duck_cursor = self.__cursor(database)
+            duck_cursor.begin()
+            try:
+                view = self.__get(duck_cursor, name)
+                if view == None:
+                    raise Exception("Couldn't find materialized view: " + name)
+                table = quote_identifier(name)
+                if full:
+                    duck_cursor.execute("DROP TABLE IF EXISTS " + table)
+                    duck_cursor.execute("DELETE FROM census_matview_files WHERE view = $name", {'name' : name})
+                # Files not loaded yet
+                duck_cursor.register('matview_selection', pa.table({'filename' : pa.array(files, pa.string())}))
+                delta = [register[0] for register in duck_cursor.execute(
+                    """SELECT filename FROM matview_selection
+                       WHERE filename NOT IN (SELECT filename FROM census_matview_files WHERE view = $name)
+                       ORDER BY filename""", {'name' : name}).fetchall()]
+                duck_cursor.unregister('matview_selection')
+                exists = view['refreshed'] != None and not full
+                if delta:
+                    bind_fset_list(duck_cursor, delta)
+                    if exists:
+                        duck_cursor.execute("INSERT INTO " + table + " BY NAME " + view['query'])
+                    else:
+                        duck_cursor.execute("CREATE TABLE " + table + " AS " + view['query'])
+                elif not exists:
+                    raise Exception('No files selected for materialized view: ' + name)
+                now = datetime.datetime.utcnow()
+                duck_cursor.register('matview_delta', pa.table({'filename' : pa.array(delta, pa.string())}))
+                duck_cursor.execute("INSERT INTO census_matview_files SELECT $name, filename, $now FROM matview_delta",
+                                    {'name' : name, 'now' : now})
+                duck_cursor.unregister('matview_delta')
+                duck_cursor.execute("""UPDATE census_matview SET refreshed = $now,
+                                       files = (SELECT count(*) FROM census_matview_files WHERE view = $name)
+                                       WHERE name = $name""", {'name' : name, 'now' : now})
+                duck_cursor.commit()
+            except Exception:
+                duck_cursor.rollback()
+                raise
+            finally:
+                duck_cursor.close()
+        matview_logger.debug("materialized view refreshed: " + database + "." + name + " files: " + str(len(delta)))
+        return {"name" : name, "appended_files" : len(delta), "full" : full}
+
+    def drop(self, database, name):
+        with self.__view_lock(database, name):
+            duck_cursor = self.__cursor(database)
+            duck_cursor.begin()
+            try:
+                duck_cursor.execute("DROP TABLE IF EXISTS " + quote_identifier(name))
+                duck_cursor.execute("DELETE FROM census_matview_files WHERE view = $name", {'name' : name})
+                duck_cursor.execute("DELETE FROM census_matview WHERE name = $name", {'name' : name})
+                duck_cursor.commit()
+            except Exception:
+                duck_cursor.rollback()
+                raise
+            finally:
+                duck_cursor.close()
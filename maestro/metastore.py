@@ -0,0 +1,355 @@
+import os
+import sys
+import json
+import fcntl
+import argparse
+import threading
+import logging
+import atexit
+from contextlib import contextmanager
+
+# Get the maestro logger
+meta_logger = logging.getLogger('maestro')
+
+# Write-behind queue for metadata files
+# fset (DuckDB) is updated synchronously and is the source of truth while the
+# process runs. Metadata files are written by a background thread, so a batch
+# of updates costs one queue operation per file on the request path
+# Writing the same file twice before it's flushed only writes the last version
+# fsync policy:
+#   'always' - fsync each file and its directory before the next one
+#   'batch'  - fsync all files of a batch, then each directory once
+#   'never'  - leave it to the OS
+class SidecarWriter:
+    backend = 'sidecar'
+
+    def __init__(self, fsync='batch'):
+        if fsync not in ('always', 'batch', 'never'):
+            raise Exception('Unknown fsync policy: ' + str(fsync))
+        self.fsync = fsync
+        # full_filename -> meta_data (JSON string)
+        self.pending = {}
+        self.writing = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='sidecar-writer', daemon=True)
+        self.thread.start()
+        # Don't lose queued metadata on a clean shutdown
+        atexit.register(self.flush)
+
+    def write(self, full_filename, meta_data):
+        with self.cond:
+            self.pending[full_filename] = meta_data
+            self.cond.notify_all()
+
+    def write_many(self, files):
+        with self.cond:
+            for full_filename, meta_data in files:
+                self.pending[full_filename] = meta_data
+            self.cond.notify_all()
+
+    # What to queue for the metadata record of a file of directory
+    def metadata(self, directory, record):
+        return sidecar_filename(directory, record['filename']), json.dumps([record], indent=4)
+
+    # Wait until everything queued so far is on disk
+    def flush(self):
+        with self.cond:
+            while self.pending or self.writing:
+                self.cond.wait()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                batch = self.pending
+                self.pending = {}
+                self.writing = True
+            try:
+                self.write_batch(batch)
+            except Exception as error:
+                meta_logger.error("Error writing metadata: " + str(error))
+            finally:
+                with self.cond:
+                    self.writing = False
+                    self.cond.notify_all()
+
+    def write_batch(self, batch):
+        directories = set()
+        renames = []
+        for full_filename, meta_data in batch.items():
+            tmp_filename = full_filename + '.tmp'
+            try:
+                with open(tmp_filename, 'w') as f_out:
+                    f_out.write(meta_data)
+                    if self.fsync != 'never':
+                        f_out.flush()
+                        os.fsync(f_out.fileno())
+            except OSError as error:
+                # e.g. the directory was removed meanwhile
+                meta_logger.warning("Error writing metadata: " + full_filename + " error: " + str(error))
+                continue
+            if self.fsync == 'always':
+                os.replace(tmp_filename, full_filename)
+                fsync_dir(os.path.dirname(full_filename))
+            else:
+                renames.append((tmp_filename, full_filename))
+        for tmp_filename, full_filename in renames:
+            os.replace(tmp_filename, full_filename)
+            directories.add(os.path.dirname(full_filename))
+        if self.fsync == 'batch':
+            for directory in directories:
+                fsync_dir(directory)
+        meta_logger.debug("metadata files written: " + str(len(batch)))
+
+# Per-directory manifest: one JSON record per line, appended on every change
+# The last record of a file wins, {"filename", "path", "deleted": true} takes
+# it out. Compaction rewrites it with the last record of each file
+# Writers hold an exclusive flock on the manifest while appending or compacting
+# Directories only have a manifest when METADATA_BACKEND is 'manifest' or
+# after a migration, fset reads both kinds
+class ManifestWriter(SidecarWriter):
+    backend = 'manifest'
+
+    # A manifest is compacted when it has more than compact_ratio lines per
+    # file in it, and at least compact_min_lines lines
+    def __init__(self, fsync='batch', compact_ratio=2, compact_min_lines=1000):
+        # manifest filename -> (lines, files) when last read or compacted
+        self.counts = {}
+        self.compact_ratio = compact_ratio
+        self.compact_min_lines = compact_min_lines
+        super().__init__(fsync)
+
+    # Records are appended, not replaced: manifest filename -> [lines]
+    def write(self, full_filename, meta_data):
+        self.write_many([(full_filename, meta_data)])
+
+    def write_many(self, files):
+        with self.cond:
+            for full_filename, meta_data in files:
+                self.pending.setdefault(full_filename, []).append(meta_data)
+            self.cond.notify_all()
+
+    def metadata(self, directory, record):
+        return os.path.join(directory, MANIFEST_FILENAME), json.dumps(record) + '\n'
+
+    def write_batch(self, batch):
+        directories = set()
+        for full_filename, lines in batch.items():
+            try:
+                with locked_manifest(full_filename) as f_out:
+                    created = f_out.tell() == 0
+                    f_out.write(''.join(lines))
+                    f_out.flush()
+                    if self.fsync != 'never':
+                        os.fsync(f_out.fileno())
+                    if self.__should_compact(full_filename, len(lines)):
+                        compact_manifest(full_filename, self.fsync != 'never')
+                        self.counts.pop(full_filename, None)
+            except OSError as error:
+                # e.g. the directory was removed meanwhile
+                meta_logger.warning("Error writing metadata: " + full_filename + " error: " + str(error))
+                continue
+            if created:
+                if self.fsync == 'always':
+                    fsync_dir(os.path.dirname(full_filename))
+                else:
+                    directories.add(os.path.dirname(full_filename))
+        if self.fsync == 'batch':
+            for directory in directories:
+                fsync_dir(directory)
+        meta_logger.debug("manifests written: " + str(len(batch)))
+
+    # Called holding the manifest lock, after appending new_lines
+    def __should_compact(self, full_filename, new_lines):
+        if full_filename not in self.counts:
+            self.counts[full_filename] = manifest_counts(full_filename)
+        else:
+            lines, files = self.counts[full_filename]
+            self.counts[full_filename] = (lines + new_lines, files)
+        lines, files = self.counts[full_filename]
+        if lines < self.compact_min_lines or lines <= self.compact_ratio * files:
+            return False
+        # The files of the new lines may not have been counted
+        lines, files = manifest_counts(full_filename)
+        self.counts[full_filename] = (lines, files)
+        return lines >= self.compact_min_lines and lines > self.compact_ratio * files
+
+MANIFEST_FILENAME = '.census_manifest.ndjson'
+
+def sidecar_filename(directory, filename):
+    return os.path.join(directory, '.' + filename + '.json')
+
+# mtime (ns) of a directory's metadata: appending to a manifest doesn't change
+# the mtime of its directory
+def metadata_mtime(directory):
+    mtime = os.stat(directory).st_mtime_ns
+    try:
+        return max(mtime, os.stat(os.path.join(directory, MANIFEST_FILENAME)).st_mtime_ns)
+    except FileNotFoundError:
+        return mtime
+
+# Records of a manifest in order, bad lines (e.g. cut by a crash) are skipped
+def read_manifest_lines(full_filename):
+    records = []
+    try:
+        with open(full_filename) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    meta_logger.warning("Bad manifest line in " + full_filename)
+    except FileNotFoundError:
+        pass
+    return records
+
+# filename -> last record, for the files in the manifest
+def read_manifest(full_filename):
+    files = {}
+    for record in read_manifest_lines(full_filename):
+        if record.get('deleted', False):
+            files.pop(record['filename'], None)
+        else:
+            files[record['filename']] = record
+    return files
+
+# (lines, files) of a manifest
+def manifest_counts(full_filename):
+    records = read_manifest_lines(full_filename)
+    files = set()
+    for record in records:
+        if record.get('deleted', False):
+            files.discard(record['filename'])
+        else:
+            files.add(record['filename'])
+    return len(records), len(files)
+
+# The manifest opened for appending, with an exclusive lock
+# A compaction replaces the file, so the lock must be on the current one
+@contextmanager
+def locked_manifest(full_filename):
+    while True:
+        f_out = open(full_filename, 'a')
+        fcntl.flock(f_out.fileno(), fcntl.LOCK_EX)
+        try:
+            if os.fstat(f_out.fileno()).st_ino == os.stat(full_filename).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        f_out.close()
+    try:
+        yield f_out
+    finally:
+        f_out.close()
+
+# Rewrite a manifest with the last record of each file
+# Must be called holding its lock
+def compact_manifest(full_filename, fsync=True, records=None):
+    if records == None:
+        records = read_manifest(full_filename)
+    tmp_filename = full_filename + '.tmp'
+    with open(tmp_filename, 'w') as f_out:
+        for record in records.values():
+            f_out.write(json.dumps(record) + '\n')
+        if fsync:
+            f_out.flush()
+            os.fsync(f_out.fileno())
+    os.replace(tmp_filename, full_filename)
+    if fsync:
+        fsync_dir(os.path.dirname(full_filename))
+    meta_logger.debug("manifest compacted: " + full_filename + " files: " + str(len(records)))
+
+# Remove the metadata of files of a directory from both kinds of store
+def remove_metadata(directory, filenames):
+    for filename in filenames:
+        try:
+            os.remove(sidecar_filename(directory, filename))
+        except FileNotFoundError:
+            pass
+    manifest = os.path.join(directory, MANIFEST_FILENAME)
+    if not os.path.exists(manifest):
+        return
+    with locked_manifest(manifest) as f_out:
+        listed = read_manifest(manifest)
+        lines = [json.dumps({"filename" : filename, "path" : listed[filename]['path'], "deleted" : True}) + '\n'
+                 for filename in filenames if filename in listed]
+        f_out.write(''.join(lines))
+
+# Move the metadata files of every directory under root into its manifest
+# Records already in a manifest are replaced by the metadata file of the same
+# file. The metadata files are removed once the manifest is on disk, unless
+# keep_sidecars
+# Returns (directories, files) migrated
+def migrate_to_manifest(root, keep_sidecars=False):
+    directories = 0
+    migrated = 0
+    for directory, subdirs, filenames in os.walk(root):
+        sidecars = [filename for filename in filenames
+                    if filename.startswith('.') and filename.endswith('.json')]
+        records = {}
+        for filename in list(sidecars):
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    for record in json.load(f):
+                        records[record['filename']] = record
+            except (OSError, ValueError, KeyError, TypeError) as error:
+                meta_logger.warning("Skipping metadata file " + os.path.join(directory, filename) + ": " + str(error))
+                sidecars.remove(filename)
+        if not records:
+            continue
+        manifest = os.path.join(directory, MANIFEST_FILENAME)
+        with locked_manifest(manifest):
+            files = read_manifest(manifest)
+            files.update(records)
+            compact_manifest(manifest, records=files)
+        if not keep_sidecars:
+            for filename in sidecars:
+                os.remove(os.path.join(directory, filename))
+        directories += 1
+        migrated += len(records)
+    return directories, migrated
+
+# Compact every manifest under root
+def compact_all(root):
+    compacted = 0
+    for directory, subdirs, filenames in os.walk(root):
+        if MANIFEST_FILENAME in filenames:
+            manifest = os.path.join(directory, MANIFEST_FILENAME)
+            with locked_manifest(manifest):
+                compact_manifest(manifest)
+            compacted += 1
+    return compacted
+
+# Make a rename durable
+def fsync_dir(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError as error:
+        meta_logger.debug(error)
+
+# Metadata maintenance, run with the file_dir of census_local:
+#   python metastore.py migrate <file_dir> [--keep-sidecars]
+#   python metastore.py compact <file_dir>
+# Stop maestro before migrating, its write-behind queue may still hold
+# metadata files. Start it with METADATA_BACKEND = 'manifest' afterwards
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='census metadata store')
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate = commands.add_parser('migrate', help='move metadata files into per-directory manifests')
+    migrate.add_argument('root')
+    migrate.add_argument('--keep-sidecars', action='store_true', help="don't remove the metadata files")
+    compact = commands.add_parser('compact', help='compact every manifest')
+    compact.add_argument('root')
+    args = parser.parse_args()
+    if not os.path.isdir(args.root):
+        sys.exit('Not a directory: ' + args.root)
+    if args.command == 'migrate':
+        directories, migrated = migrate_to_manifest(args.root, args.keep_sidecars)
+        print("directories: " + str(directories) + " files: " + str(migrated))
+    else:
+        print("manifests compacted: " + str(compact_all(args.root)))
@@ -0,0 +1,116 @@
+import json
+import time
+import logging
+import psutil
+
+# Get the maestro logger
+stats_logger = logging.getLogger('maestro')
+
+# Resource usage of a process and all its descendants, sampled over time
+# CPU time and I/O bytes are cumulative per process. The last values seen of
+# each process are kept, so processes that already ended still count
+# Every sample is appended to series_filename (one JSON per line)
+class ProcessSampler:
+    def __init__(self, pid, series_filename):
+        self.pid = pid
+        self.series_filename = series_filename
+        # pid -> (cpu seconds, read bytes, write bytes)
+        self.seen = {}
+        self.last = None
+
+    def __tree(self):
+        try:
+            root = psutil.Process(self.pid)
+            return [root] + root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return []
+
+    # Nothing used yet, the start of the series
+    # Sampling now would read the server process forked but not exec'd yet
+    def baseline(self):
+        return self.__record(0, 0, 0, 0, 0)
+
+    # Take a sample, returns it or None when the process is gone
+    def sample(self):
+        processes = self.__tree()
+        if not processes:
+            return None
+        rss = 0
+        alive = 0
+        for process in processes:
+            try:
+                with process.oneshot():
+                    cpu = process.cpu_times()
+                    memory = process.memory_info()
+                    try:
+                        io = process.io_counters()
+                        read_bytes, write_bytes = io.read_bytes, io.write_bytes
+                    except (psutil.AccessDenied, AttributeError):
+                        # Not available on every platform
+                        read_bytes, write_bytes = 0, 0
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                continue
+            rss += memory.rss
+            alive += 1
+            self.seen[process.pid] = (cpu.user + cpu.system, read_bytes, write_bytes)
+        return self.__record(sum(seen[0] for seen in self.seen.values()), rss,
+                             sum(seen[1] for seen in self.seen.values()),
+                             sum(seen[2] for seen in self.seen.values()), alive)
+
+    # Last sample, once the process was reaped
+    # rusage (os.wait4) counts the process and the children it waited for,
+    # including what they used after the last sample
+    def finish(self, rusage=None):
+        cpu_seconds = sum(seen[0] for seen in self.seen.values())
+        read_bytes = sum(seen[1] for seen in self.seen.values())
+        write_bytes = sum(seen[2] for seen in self.seen.values())
+        if rusage != None:
+            cpu_seconds = max(cpu_seconds, rusage.ru_utime + rusage.ru_stime)
+            # Blocks of 512 bytes, the same accounting as io_counters
+            read_bytes = max(read_bytes, rusage.ru_inblock * 512)
+            write_bytes = max(write_bytes, rusage.ru_oublock * 512)
+        return self.__record(cpu_seconds, 0, read_bytes, write_bytes, 0)
+
+    def __record(self, cpu_seconds, rss, read_bytes, write_bytes, processes):
+        now = time.time()
+        sample = {"time" : now,
+                  "cpu_seconds" : round(cpu_seconds, 3),
+                  "cpu_percent" : 0.0,
+                  "rss" : rss,
+                  "read_bytes" : read_bytes,
+                  "write_bytes" : write_bytes,
+                  "processes" : processes}
+        if self.last != None and now > self.last['time']:
+            sample['cpu_percent'] = round(100 * (sample['cpu_seconds'] - self.last['cpu_seconds']) / (now - self.last['time']), 1)
+        self.last = sample
+        try:
+            with open(self.series_filename, 'a') as f_out:
+                f_out.write(json.dumps(sample) + '\n')
+        except OSError as error:
+            stats_logger.warning("Error writing process samples: " + str(error))
+        return sample
+
+# Samples of a run, in time order
+def read_series(series_filename):
+    try:
+        with open(series_filename) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+# Peak and average usage of a series of samples
+def summarize(series):
+    if not series:
+        return None
+    last = series[-1]
+    seconds = last['time'] - series[0]['time']
+    return {"samples" : len(series),
+            "seconds" : round(seconds, 1),
+            "cpu_seconds" : last['cpu_seconds'],
+            "cpu_percent_peak" : max(sample['cpu_percent'] for sample in series),
+            "cpu_percent_avg" : round(100 * (last['cpu_seconds'] - series[0]['cpu_seconds']) / seconds, 1) if seconds > 0 else 0.0,
+            "rss_peak" : max(sample['rss'] for sample in series),
+            "rss_avg" : int(sum(sample['rss'] for sample in series) / len(series)),
+            "read_bytes" : last['read_bytes'],
+            "write_bytes" : last['write_bytes'],
+            "processes_peak" : max(sample['processes'] for sample in series)}
@@ -0,0 +1,232 @@
+import os
+import json
+import uuid
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+import duckdb
+import pyarrow as pa
+
+# Get the maestro logger
+qcache_logger = logging.getLogger('maestro')
+
+# Arrow table of a relation, for the cache
+# Columns are renamed c0, c1... (names may repeat in a result), the names and
+# DuckDB types are kept in the schema metadata to convert it back
+def result_table(result):
+    table = result.arrow()
+    table = table.rename_columns(['c' + str(i) for i in range(table.num_columns)])
+    return table.replace_schema_metadata({
+        'columns' : json.dumps(result.columns),
+        'types' : json.dumps([str(type_) for type_ in result.types])})
+
+def result_columns(table):
+    return json.loads(table.schema.metadata[b'columns'])
+
+# One cached result
+class CacheEntry:
+    def __init__(self, database, fset_version, table=None, filename=None, nbytes=0):
+        self.database = database
+        self.fset_version = fset_version
+        # Arrow table when in memory, IPC file when spilled to disk
+        self.table = table
+        self.filename = filename
+        self.nbytes = nbytes
+
+# Results of read-only queries, as Arrow tables
+# An entry is found by (database, query, filter, FileSet version, state of the
+# database file), so new or changed files, writes from other connections and
+# checkpoints all lead to a different key. Entries of an older FileSet version
+# are dropped as soon as a newer version is seen
+# Memory is bounded by max_bytes, least recently used entries are evicted to
+# spill_dir (up to spill_max_bytes) when given, or dropped
+class QueryCache:
+    def __init__(self, db_dir, max_bytes, spill_dir=None, spill_max_bytes=0):
+        self.db_dir = db_dir
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        # key -> CacheEntry, least recently used first
+        self.memory = OrderedDict()
+        self.spilled = OrderedDict()
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+        self.fset_version = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Parses queries and converts cached results, no data of its own
+        self.parser = duckdb.connect()
+        self.parser_lock = threading.Lock()
+        if self.spill_dir:
+            # Spilled entries don't outlive the process
+            os.makedirs(self.spill_dir, exist_ok=True)
+            for filename in os.listdir(self.spill_dir):
+                if filename.endswith('.arrow'):
+                    os.remove(os.path.join(self.spill_dir, filename))
+
+    # Normalized form of a query that only reads (its syntax tree), None if
+    # any of its statements may write
+    def normalize(self, query):
+        with self.parser_lock:
+            serialized = self.parser.execute('SELECT json_serialize_sql($query::VARCHAR)',
+                                             {'query' : query}).fetchone()[0]
+        if json.loads(serialized).get('error', False):
+            return None
+        return serialized
+
+    # Rows of a cached result, as fetchall on the relation returned them
+    # Arrow doesn't have every DuckDB type (e.g. HUGEINT, MAP), so they are cast back
+    def fetchall(self, table):
+        types = json.loads(table.schema.metadata[b'types'])
+        select = ", ".join("c{}::{}".format(i, type_) for i, type_ in enumerate(types))
+        with self.parser_lock:
+            duck_cursor = self.parser.cursor()
+        try:
+            duck_cursor.register('cached', table)
+            return duck_cursor.execute("SELECT " + select + " FROM cached").fetchall()
+        finally:
+            duck_cursor.close()
+
+    # Changes whenever DuckDB writes to the database file
+    def __db_state(self, database):
+        state = []
+        for filename in (os.path.join(self.db_dir, database), os.path.join(self.db_dir, database + '.wal')):
+            try:
+                st = os.stat(filename)
+                state.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                state.append(None)
+        return state
+
+    # Cache key of the query, None if it can't be cached
+    def key(self, database, query, file_filter, fset_version):
+        normalized = self.normalize(query)
+        if normalized == None:
+            return None
+        key = json.dumps([database, normalized, file_filter, fset_version, self.__db_state(database)],
+                         sort_keys=True, default=str)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key, fset_version):
+        with self.lock:
+            self.__expire(fset_version)
+            entry = self.memory.get(key, None)
+            if entry != None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return entry.table
+            entry = self.spilled.pop(key, None)
+            if entry == None:
+                self.misses += 1
+                return None
+            self.spilled_bytes -= entry.nbytes
+            self.hits += 1
+        # Back to memory
+        try:
+            with pa.memory_map(entry.filename) as source:
+                table = pa.ipc.open_file(source).read_all()
+        except OSError as error:
+            qcache_logger.warning("Error reading cached result: " + str(error))
+            return None
+        finally:
+            self.__remove_file(entry.filename)
+        self.put(key, entry.database, entry.fset_version, table)
+        return table
+
+    def put(self, key, database, fset_version, table):
+        entry = CacheEntry(database, fset_version, table=table, nbytes=table.nbytes)
+        spill = []
+        with self.lock:
+            self.__expire(fset_version)
+            if fset_version != self.fset_version:
+                # Computed on an older FileSet
+                return
+            self.__drop(key)
+            if entry.nbytes > self.max_bytes:
+                spill.append((key, entry))
+            else:
+                self.memory[key] = entry
+                self.memory_bytes += entry.nbytes
+                while self.memory_bytes > self.max_bytes:
+                    old_key, old_entry = self.memory.popitem(last=False)
+                    self.memory_bytes -= old_entry.nbytes
+                    spill.append((old_key, old_entry))
+        for old_key, old_entry in spill:
+            self.__spill(old_key, old_entry)
+
+    # Drop the entries of database, e.g. after a query wrote to it
+    def invalidate(self, database):
+        with self.lock:
+            for entries in (self.memory, self.spilled):
+                for key in [key for key, entry in entries.items() if entry.database == database]:
+                    self.__drop(key)
+
+    def stats(self):
+        with self.lock:
+            return {"entries" : len(self.memory),
+                    "bytes" : self.memory_bytes,
+                    "spilled_entries" : len(self.spilled),
+                    "spilled_bytes" : self.spilled_bytes,
+                    "hits" : self.hits,
+                    "misses" : self.misses,
+                    "fset_version" : self.fset_version}
+
+    # Must be called with self.lock held
+    def __drop(self, key):
+        entry = self.memory.pop(key, None)
+        if entry != None:
+            self.memory_bytes -= entry.nbytes
+            return entry
+        entry = self.spilled.pop(key, None)
+        if entry != None:
+            self.spilled_bytes -= entry.nbytes
+            if entry.filename:
+                self.__remove_file(entry.filename)
+        return entry
+
+    # Forget entries of other FileSet versions. Must be called with self.lock held
+    def __expire(self, fset_version):
+        if fset_version == self.fset_version:
+            return
+        if self.fset_version != None and fset_version < self.fset_version:
+            # A late request still on an older FileSet
+            return
+        self.fset_version = fset_version
+        for entries in (self.memory, self.spilled):
+            for key in [key for key, entry in entries.items() if entry.fset_version != fset_version]:
+                self.__drop(key)
+
+    def __spill(self, key, entry):
+        if not self.spill_dir or entry.nbytes > self.spill_max_bytes:
+            return
+        filename = os.path.join(self.spill_dir, str(uuid.uuid4()) + '.arrow')
+        try:
+            with pa.OSFile(filename, 'wb') as sink:
+                with pa.ipc.new_file(sink, entry.table.schema) as writer:
+                    writer.write_table(entry.table)
+        except OSError as error:
+            qcache_logger.warning("Error spilling cached result: " + str(error))
+            self.__remove_file(filename)
+            return
+        spilled = CacheEntry(entry.database, entry.fset_version, filename=filename, nbytes=entry.nbytes)
+        removed = []
+        with self.lock:
+            if entry.fset_version != self.fset_version or key in self.memory or key in self.spilled:
+                removed.append(filename)
+            else:
+                self.spilled[key] = spilled
+                self.spilled_bytes += spilled.nbytes
+                while self.spilled_bytes > self.spill_max_bytes:
+                    old_key, old_entry = self.spilled.popitem(last=False)
+                    self.spilled_bytes -= old_entry.nbytes
+                    removed.append(old_entry.filename)
+        for filename in removed:
+            self.__remove_file(filename)
+
+    def __remove_file(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import signal
+import socket
+import sqlite3
+import threading
+import logging
+from contextlib import contextmanager
+import psutil
+from procstats import ProcessSampler, read_series, summarize
+
+# Get the maestro logger
+scheduler_logger = logging.getLogger('maestro')
+
+JOB_DDL = '''CREATE TABLE IF NOT EXISTS extractor_job (
+    exec_id TEXT PRIMARY KEY,
+    tap TEXT NOT NULL,
+    target TEXT NOT NULL,
+    status TEXT NOT NULL,
+    pid INTEGER,
+    owner TEXT,
+    returncode INTEGER,
+    timeout REAL,
+    submitted REAL NOT NULL,
+    started REAL,
+    ended REAL,
+    error TEXT,
+    usage TEXT)'''
+
+# Job states: queued -> running -> done | failed | timeout, or cancelled
+
+# Meltano runs, at most max_running at once and one at a time per target
+# The job table is a SQLite file, so every server process (e.g. several
+# workers) shares the same queue and limits. A job is claimed inside an
+# IMMEDIATE transaction, so two processes never start the same job
+# launch(job) starts the process of a job (a dict of its extractor_job row) and returns
+# the Popen, only the process that started it waits for it
+# The process tree of every run is sampled each interval into
+# stats_dir/<exec_id>.usage.ndjson, and read a last time from its rusage when
+# it's reaped. Its peak and average usage are kept in the job table (usage)
+# when it ends
+class ExtractorScheduler:
+    def __init__(self, db_file, max_running, default_timeout, launch, interval=5, stats_dir=None):
+        self.db_file = db_file
+        self.max_running = max_running
+        self.default_timeout = default_timeout
+        self.launch = launch
+        self.interval = interval
+        self.stats_dir = stats_dir
+        self.owner = socket.gethostname() + ':' + str(os.getpid())
+        # exec_id -> (Popen, ProcessSampler) of the jobs started here
+        self.processes = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        with self.__connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(JOB_DDL)
+            # Tables created before usage was sampled
+            columns = [row['name'] for row in conn.execute('PRAGMA table_info(extractor_job)')]
+            if 'usage' not in columns:
+                conn.execute('ALTER TABLE extractor_job ADD COLUMN usage TEXT')
+            conn.execute('CREATE INDEX IF NOT EXISTS extractor_job_status ON extractor_job (status, submitted)')
+
+    # Autocommit connection, transactions are opened explicitly
+    @contextmanager
+    def __connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def submit(self, exec_id, tap, target, timeout=None):
+        with self.__connect() as conn:
+            conn.execute('INSERT INTO extractor_job (exec_id, tap, target, status, timeout, submitted) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (exec_id, tap, target, 'queued', timeout or self.default_timeout, time.time()))
+        scheduler_logger.debug("extractor job queued: " + exec_id + " " + tap + " " + target)
+        self.dispatch()
+        return self.get(exec_id)
+
+    def get(self, exec_id):
+        with self.__connect() as conn:
+            row = conn.execute('SELECT * FROM extractor_job WHERE exec_id = ?', (exec_id,)).fetchone()
+        return self.__job(row) if row else None
+
+    def __job(self, row):
+        job = dict(row)
+        if job['usage']:
+            job['usage'] = json.loads(job['usage'])
+        return job
+
+    def series_filename(self, exec_id):
+        return os.path.join(self.stats_dir, exec_id + '.usage.ndjson')
+
+    # Samples of the run and their peak and average, also while it's running
+    def usage(self, exec_id):
+        if self.stats_dir == None:
+            return None, []
+        series = read_series(self.series_filename(exec_id))
+        return summarize(series), series
+
+    def list(self, status=None, limit=100):
+        query = 'SELECT * FROM extractor_job'
+        params = []
+        if status:
+            query += ' WHERE status = ?'
+            params.append(status)
+        query += ' ORDER BY submitted DESC LIMIT ?'
+        params.append(limit)
+        with self.__connect() as conn:
+            return [self.__job(row) for row in conn.execute(query, params)]
+
+    # Cancel a queued or running job
+    # Returns the job, or None if it doesn't exist
+    def cancel(self, exec_id):
+        with self.__connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            job = conn.execute('SELECT * FROM extractor_job WHERE exec_id = ?', (exec_id,)).fetchone()
+            if job == None:
+                conn.execute('ROLLBACK')
+                return None
+            if job['status'] in ('queued', 'running'):
+                self.__finish(conn, exec_id, 'cancelled', error='cancelled')
+            conn.execute('COMMIT')
+        if job['status'] == 'running' and job['pid']:
+            self.__kill(job['pid'])
+        self.wakeup.set()
+        return self.get(exec_id)
+
+    # Start queued jobs while there are free slots and their target is free
+    def dispatch(self):
+        claimed = []
+        with self.__connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            running = conn.execute("SELECT target FROM extractor_job WHERE status = 'running'").fetchall()
+            busy = set(row['target'] for row in running)
+            slots = self.max_running - len(running)
+            for job in conn.execute("SELECT * FROM extractor_job WHERE status = 'queued' ORDER BY submitted").fetchall():
+                if slots <= 0:
+                    break
+                if job['target'] in busy:
+                    continue
+                conn.execute("UPDATE extractor_job SET status = 'running', owner = ?, started = ? WHERE exec_id = ?",
+                             (self.owner, time.time(), job['exec_id']))
+                busy.add(job['target'])
+                slots -= 1
+                claimed.append(dict(job))
+            conn.execute('COMMIT')
+
+        for job in claimed:
+            try:
+                process = self.launch(job)
+            except Exception as error:
+                scheduler_logger.warning("extractor job failed to start: " + job['exec_id'] + " error: " + str(error))
+                with self.__connect() as conn:
+                    self.__finish(conn, job['exec_id'], 'failed', error=str(error))
+                continue
+            sampler = None
+            if self.stats_dir != None:
+                sampler = ProcessSampler(process.pid, self.series_filename(job['exec_id']))
+                sampler.baseline()
+            with self.lock:
+                self.processes[job['exec_id']] = (process, sampler)
+            with self.__connect() as conn:
+                conn.execute('UPDATE extractor_job SET pid = ? WHERE exec_id = ?', (process.pid, job['exec_id']))
+            scheduler_logger.debug("extractor job started: " + job['exec_id'] + " pid: " + str(process.pid))
+        return len(claimed)
+
+    # Collect the jobs that ended, enforce timeouts and clean up after dead owners
+    def reap(self):
+        now = time.time()
+        with self.lock:
+            processes = list(self.processes.items())
+        for exec_id, (process, sampler) in processes:
+            returncode, rusage = self.__wait(process)
+            if returncode == None:
+                if sampler:
+                    sampler.sample()
+                continue
+            with self.lock:
+                del self.processes[exec_id]
+            if sampler:
+                sampler.finish(rusage)
+            status = 'done' if returncode == 0 else 'failed'
+            summary, series = self.usage(exec_id)
+            with self.__connect() as conn:
+                self.__finish(conn, exec_id, status, returncode=returncode)
+                # Also for cancelled and timed out runs
+                conn.execute('UPDATE extractor_job SET usage = ? WHERE exec_id = ?',
+                             (json.dumps(summary) if summary else None, exec_id))
+            scheduler_logger.debug("extractor job " + status + ": " + exec_id + " returncode: " + str(returncode))
+
+        with self.__connect() as conn:
+            running = conn.execute("SELECT * FROM extractor_job WHERE status = 'running'").fetchall()
+        for job in running:
+            if job['timeout'] and job['started'] and now - job['started'] > job['timeout']:
+                with self.__connect() as conn:
+                    self.__finish(conn, job['exec_id'], 'timeout', error='timeout after ' + str(job['timeout']) + 's')
+                if job['pid']:
+                    self.__kill(job['pid'])
+                scheduler_logger.warning("extractor job timeout: " + job['exec_id'])
+            elif job['owner'] != self.owner and not self.__owner_alive(job['owner']):
+                # The server that started it is gone, nobody will wait for it
+                with self.__connect() as conn:
+                    self.__finish(conn, job['exec_id'], 'failed', error='server stopped: ' + job['owner'])
+                if job['pid']:
+                    self.__kill(job['pid'])
+
+    # Same as process.poll(), plus the resource usage of the process and the
+    # children it waited for (None if it ended before)
+    def __wait(self, process):
+        if process.returncode != None:
+            return process.returncode, None
+        try:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        except ChildProcessError:
+            # Reaped elsewhere
+            return process.poll(), None
+        if pid == 0:
+            return None, None
+        process.returncode = os.waitstatus_to_exitcode(status)
+        return process.returncode, rusage
+
+    def __finish(self, conn, exec_id, status, returncode=None, error=None):
+        # A job ends only once, e.g. a cancelled job stays cancelled when its process exits
+        conn.execute("UPDATE extractor_job SET status = ?, returncode = ?, error = ?, ended = ? "
+                     "WHERE exec_id = ? AND status IN ('queued', 'running')",
+                     (status, returncode, error, time.time(), exec_id))
+
+    # Processes of this host only, others can't be checked from here
+    def __owner_alive(self, owner):
+        host, pid = owner.rsplit(':', 1)
+        if host != socket.gethostname():
+            return True
+        return psutil.pid_exists(int(pid))
+
+    # Meltano runs its plugins as children, the whole process group goes
+    def __kill(self, pid):
+        try:
+            os.killpg(os.getpgid(pid), signal.SIGTERM)
+        except (ProcessLookupError, PermissionError) as error:
+            scheduler_logger.debug("extractor kill " + str(pid) + ": " + str(error))
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.reap()
+                self.dispatch()
+            except Exception as error:
+                scheduler_logger.error("extractor scheduler error: " + str(error))
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='extractor-scheduler', daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,57 @@
+import io
+import json
+import logging
+import pyarrow as pa
+
+# Get the maestro logger
+stream_logger = logging.getLogger('maestro')
+
+# Generate the result of a query as NDJSON (one JSON record per line)
+# Rows are pulled from the relation batch_size at a time, so memory is bounded
+# by the batch and not by the size of the result
+# duck_cursor is closed when the generator ends (or the client goes away)
+def ndjson_stream(duck_cursor, result, batch_size):
+    columns = result.columns
+    rows_sent = 0
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            lines = [json.dumps(dict(zip(columns, register)), default=str) for register in rows]
+            rows_sent += len(rows)
+            yield '\n'.join(lines) + '\n'
+            if len(rows) < batch_size:
+                break
+    except Exception as error:
+        # Headers are gone already, report the error as the last line
+        stream_logger.warning("error streaming sql result: " + str(error))
+        yield json.dumps({"error" : str(error)}) + '\n'
+    finally:
+        duck_cursor.close()
+        stream_logger.debug("streamed rows: " + str(rows_sent))
+
+# Generate the result of a query as an Apache Arrow IPC stream
+# DuckDB hands over record batches, there is no per-row Python work
+# duck_cursor is closed when the generator ends (or the client goes away)
+def arrow_stream(duck_cursor, result, batch_size):
+    sink = io.BytesIO()
+    rows_sent = 0
+    try:
+        reader = result.record_batch(batch_size)
+        with pa.ipc.new_stream(sink, reader.schema) as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+                rows_sent += batch.num_rows
+                # Send what has been written so far
+                yield sink.getvalue()
+                sink.seek(0)
+                sink.truncate()
+        # End of stream marker
+        yield sink.getvalue()
+    except Exception as error:
+        # Headers are gone already, all we can do is cut the stream
+        stream_logger.warning("error streaming arrow result: " + str(error))
+    finally:
+        duck_cursor.close()
+        stream_logger.debug("streamed arrow rows: " + str(rows_sent))
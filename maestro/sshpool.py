@@ -0,0 +1,186 @@
+import os
+import stat
+import json
+import time
+import socket
+import hashlib
+import fnmatch
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+import paramiko
+
+# Get the maestro logger
+ssh_logger = logging.getLogger('maestro')
+
+# Paramiko key from the private key text
+def load_private_key(private_key):
+    #create a virtual file
+    not_really_a_file = StringIO(private_key)
+    # import as paramiko key
+    return paramiko.RSAKey.from_private_key(not_really_a_file)
+
+# One authenticated SSH connection, shared by every request to the same
+# (server, port, username, key). SFTP channels are opened on it as needed
+class SSHSession:
+    def __init__(self, key, transport):
+        self.key = key
+        self.transport = transport
+        self.last_used = time.monotonic()
+        self.in_use = 0
+
+class SSHPool:
+    def __init__(self, idle_timeout, keepalive, window_size, connect_timeout=30):
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.window_size = window_size
+        self.connect_timeout = connect_timeout
+        # key -> SSHSession
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def __key(self, server, port, username, p_key):
+        fingerprint = hashlib.sha256(p_key.asbytes()).hexdigest()
+        return (server, int(port), username, fingerprint)
+
+    def __connect(self, server, port, username, p_key):
+        sock = socket.create_connection((server, int(port)), timeout=self.connect_timeout)
+        # Bigger windows keep more data in flight on high latency links
+        transport = paramiko.Transport(sock, default_window_size=self.window_size)
+        transport.connect(username=username, pkey=p_key)
+        transport.set_keepalive(self.keepalive)
+        ssh_logger.debug("Opened ssh session: " + username + "@" + server + ":" + str(port))
+        return transport
+
+    # Get the session, connecting if there is none or it has died
+    # Every acquire must be paired with a release
+    def acquire(self, server, port, username, p_key):
+        key = self.__key(server, port, username, p_key)
+        with self.lock:
+            session = self.sessions.get(key, None)
+            if session != None and session.transport.is_active():
+                session.in_use += 1
+                return session
+        transport = self.__connect(server, port, username, p_key)
+        with self.lock:
+            old = self.sessions.get(key, None)
+            if old != None and old.transport.is_active():
+                # Another thread connected meanwhile, keep theirs
+                transport.close()
+                session = old
+            else:
+                session = SSHSession(key, transport)
+                self.sessions[key] = session
+            session.in_use += 1
+        return session
+
+    def release(self, session):
+        with self.lock:
+            session.in_use -= 1
+            session.last_used = time.monotonic()
+
+    # Close idle and dead sessions
+    def sweep(self):
+        closed = []
+        now = time.monotonic()
+        with self.lock:
+            for key, session in list(self.sessions.items()):
+                if session.in_use > 0:
+                    continue
+                if not session.transport.is_active() or now - session.last_used > self.idle_timeout:
+                    closed.append(self.sessions.pop(key))
+        for session in closed:
+            session.transport.close()
+            ssh_logger.debug("Closed ssh session: " + session.key[2] + "@" + session.key[0])
+
+    def start_sweeper(self, interval):
+        def sweeper():
+            while True:
+                time.sleep(interval)
+                self.sweep()
+        thread = threading.Thread(target=sweeper, name='ssh-sweeper', daemon=True)
+        thread.start()
+        return thread
+
+# Regular files of remote_path whose name matches pattern
+# Returns the SFTPAttributes (filename, st_size, st_mtime) of each file
+def list_remote_files(sftp, remote_path, pattern):
+    files = []
+    for attr in sftp.listdir_attr(remote_path):
+        if not stat.S_ISREG(attr.st_mode or 0):
+            continue
+        if fnmatch.fnmatch(attr.filename, pattern):
+            files.append(attr)
+    return files
+
+# Download files (remote full path, local full path) over several SFTP
+# channels of the same session. Each channel reads with prefetch, so reads
+# are pipelined instead of one round trip per block
+# callback(local_filename, bytes) is called as data arrives
+def get_remote_files(transport, files, channels, callback=None):
+    local = threading.local()
+    opened = []
+    opened_lock = threading.Lock()
+
+    def get(remote_local):
+        remote_filename, local_filename = remote_local
+        if not hasattr(local, 'sftp'):
+            local.sftp = paramiko.SFTPClient.from_transport(transport)
+            with opened_lock:
+                opened.append(local.sftp)
+        transferred = [0]
+        def progress(done, total):
+            if callback:
+                callback(local_filename, done - transferred[0])
+            transferred[0] = done
+        # Download aside and rename, a partial file never looks complete
+        directory, filename = os.path.split(local_filename)
+        part_filename = os.path.join(directory, '.' + filename + '.part')
+        local.sftp.get(remote_filename, part_filename, callback=progress)
+        os.replace(part_filename, local_filename)
+        return local_filename
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(channels, len(files)))) as executor:
+            return list(executor.map(get, files))
+    finally:
+        for sftp in opened:
+            sftp.close()
+
+# Size and mtime of the remote files already fetched into a local directory
+# One manifest per (server, port, username, remote_path, local_path)
+class SyncManifest:
+    def __init__(self, sync_dir, server, port, username, remote_path, local_path):
+        key = json.dumps([server, int(port), username, remote_path, local_path])
+        self.filename = os.path.join(sync_dir, hashlib.sha256(key.encode()).hexdigest() + '.manifest')
+        self.local_path = local_path
+        # remote filename -> {"size", "mtime"}
+        self.files = {}
+        try:
+            with open(self.filename) as f:
+                self.files = json.load(f).get('files', {})
+        except (OSError, ValueError):
+            pass
+
+    # Remote files that are new, changed or missing locally
+    def changed(self, attrs):
+        changed = []
+        for attr in attrs:
+            known = self.files.get(attr.filename, None)
+            if (known == None
+                    or known['size'] != attr.st_size
+                    or known['mtime'] != attr.st_mtime
+                    or not os.path.exists(os.path.join(self.local_path, attr.filename))):
+                changed.append(attr)
+        return changed
+
+    def update(self, attrs):
+        for attr in attrs:
+            self.files[attr.filename] = {"size" : attr.st_size, "mtime" : attr.st_mtime}
+
+    def save(self):
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f_out:
+            json.dump({"local_path" : self.local_path, "files" : self.files}, f_out)
+        os.replace(tmp_filename, self.filename)
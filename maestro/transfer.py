@@ -0,0 +1,224 @@
+import os
+import re
+import json
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+# Get the maestro logger
+transfer_logger = logging.getLogger('maestro')
+
+class DownloadError(Exception):
+    def __init__(self, status_code, text):
+        super().__init__(status_code, text)
+        self.status_code = status_code
+        self.text = text
+
+# Chunk size that grows while chunks arrive fast and shrinks when they are slow
+# Keeps the number of Python-level writes low on fast links without holding
+# big buffers on slow ones
+class AdaptiveChunk:
+    # Time a chunk should take to arrive
+    TARGET_SECONDS = 0.25
+
+    def __init__(self, min_size, max_size):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = min_size
+
+    def update(self, seconds):
+        if seconds < self.TARGET_SECONDS / 2:
+            self.size = min(self.size * 2, self.max_size)
+        elif seconds > self.TARGET_SECONDS * 2:
+            self.size = max(self.size // 2, self.min_size)
+
+# HTTP download to a local file
+# When the server supports Range requests, the file is split in segments that
+# are downloaded in parallel. Finished segments are recorded in a journal next
+# to the temporary file, so an interrupted download resumes where it stopped
+# The file only appears under its final name when it's complete
+class HttpDownload:
+    def __init__(self, url, params=None, headers=None, data=None, auth=None,
+                 workers=4, min_segment_size=8 * 1024 * 1024,
+                 min_chunk_size=64 * 1024, max_chunk_size=4 * 1024 * 1024,
+                 retries=3, timeout=60, progress=None):
+        self.url = url
+        self.params = params or {}
+        self.headers = headers or {}
+        self.data = data
+        self.auth = auth
+        self.workers = workers
+        self.min_segment_size = min_segment_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.retries = retries
+        self.timeout = timeout
+        # Called with the number of bytes of every chunk written
+        self.progress = progress
+        self.bytes_done = 0
+        self.lock = threading.Lock()
+
+    # Bytes are asked for as stored (identity), byte ranges of a compressed
+    # response would point into the compressed data
+    def __get(self, extra_headers=None):
+        headers = dict(self.headers)
+        headers['Accept-Encoding'] = 'identity'
+        if extra_headers:
+            headers.update(extra_headers)
+        return requests.get(self.url, params=self.params, headers=headers, data=self.data,
+                            auth=self.auth, stream=True, timeout=self.timeout)
+
+    def __count(self, size):
+        with self.lock:
+            self.bytes_done += size
+        if self.progress:
+            self.progress(size)
+
+    # Download into full_filename
+    # Returns the transfer statistics
+    def run(self, full_filename):
+        directory, filename = os.path.split(full_filename)
+        part_filename = os.path.join(directory, '.' + filename + '.part')
+        journal_filename = part_filename + '.journal'
+        started = time.monotonic()
+
+        # Probe for Range support
+        stream = self.__get({'Range' : 'bytes=0-'})
+        if stream.status_code not in (200, 206):
+            raise DownloadError(stream.status_code, stream.text)
+        total = None
+        # A server compressing anyway gets a single stream, decoded as it comes
+        encoding = stream.headers.get('Content-Encoding', 'identity').lower()
+        if stream.status_code == 206 and encoding == 'identity':
+            match = re.match(r'bytes \d+-\d+/(\d+)', stream.headers.get('Content-Range', ''))
+            if match:
+                total = int(match.group(1))
+        validator = stream.headers.get('ETag', stream.headers.get('Last-Modified', None))
+
+        if total == None:
+            # No ranges, a single stream from the beginning
+            segments = 1
+            resumed = 0
+            self.__single(stream, part_filename)
+            if os.path.exists(journal_filename):
+                os.remove(journal_filename)
+        else:
+            stream.close()
+            segments, resumed = self.__segmented(total, validator, part_filename, journal_filename)
+
+        os.replace(part_filename, full_filename)
+        if os.path.exists(journal_filename):
+            os.remove(journal_filename)
+        seconds = time.monotonic() - started
+        stats = {"bytes" : self.bytes_done,
+                 "size" : os.path.getsize(full_filename),
+                 "seconds" : round(seconds, 3),
+                 "rate" : int(self.bytes_done / seconds) if seconds > 0 else 0,
+                 "segments" : segments,
+                 "resumed_segments" : resumed}
+        transfer_logger.debug("HTTP download " + filename + ": " + json.dumps(stats))
+        return stats
+
+    def __single(self, stream, part_filename):
+        chunk = AdaptiveChunk(self.min_chunk_size, self.max_chunk_size)
+        with open(part_filename, 'wb') as fd:
+            raw = stream.raw
+            while True:
+                start = time.monotonic()
+                data = raw.read(chunk.size, decode_content=True)
+                if not data:
+                    break
+                chunk.update(time.monotonic() - start)
+                fd.write(data)
+                self.__count(len(data))
+        stream.close()
+
+    def __segmented(self, total, validator, part_filename, journal_filename):
+        segment_size = max(self.min_segment_size, -(-total // (self.workers * 4)))
+        segments = [(start, min(start + segment_size, total) - 1)
+                    for start in range(0, total, segment_size)]
+        # Resume when the journal belongs to this same remote file. Without
+        # ETag or Last-Modified a changed file can't be told apart, start over
+        done = set()
+        journal = self.__read_journal(journal_filename)
+        if (journal and validator != None and os.path.exists(part_filename)
+                and journal.get('url') == self.url
+                and journal.get('total') == total
+                and journal.get('validator') == validator
+                and journal.get('segment_size') == segment_size):
+            done = set(journal.get('done', []))
+        else:
+            with open(part_filename, 'wb') as fd:
+                fd.truncate(total)
+        resumed = len(done)
+        journal = {"url" : self.url,
+                   "total" : total,
+                   "validator" : validator,
+                   "segment_size" : segment_size,
+                   "done" : sorted(done)}
+        self.__write_journal(journal_filename, journal)
+
+        fd = os.open(part_filename, os.O_WRONLY)
+        journal_lock = threading.Lock()
+        def fetch(index):
+            start, end = segments[index]
+            self.__fetch_segment(fd, start, end)
+            with journal_lock:
+                journal['done'].append(index)
+                self.__write_journal(journal_filename, journal)
+        try:
+            pending = [index for index in range(len(segments)) if index not in done]
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                # Raise the first error, finished segments stay in the journal
+                for result in executor.map(fetch, pending):
+                    pass
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return len(segments), resumed
+
+    def __fetch_segment(self, fd, start, end):
+        offset = start
+        attempt = 0
+        while True:
+            try:
+                stream = self.__get({'Range' : 'bytes={}-{}'.format(offset, end)})
+                if stream.status_code != 206:
+                    raise DownloadError(stream.status_code, stream.text)
+                chunk = AdaptiveChunk(self.min_chunk_size, self.max_chunk_size)
+                raw = stream.raw
+                while offset <= end:
+                    begin = time.monotonic()
+                    data = raw.read(min(chunk.size, end - offset + 1), decode_content=False)
+                    if not data:
+                        break
+                    chunk.update(time.monotonic() - begin)
+                    os.pwrite(fd, data, offset)
+                    offset += len(data)
+                    self.__count(len(data))
+                stream.close()
+                if offset > end:
+                    return
+                raise DownloadError(None, 'connection closed before the end of the segment')
+            except (requests.RequestException, DownloadError) as error:
+                # Retry from where the segment stopped
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                transfer_logger.debug("retrying segment " + str(start) + " at " + str(offset) + ": " + str(error))
+                time.sleep(attempt)
+
+    def __read_journal(self, journal_filename):
+        try:
+            with open(journal_filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def __write_journal(self, journal_filename, journal):
+        tmp_filename = journal_filename + '.tmp'
+        with open(tmp_filename, 'w') as f_out:
+            json.dump(journal, f_out)
+        os.replace(tmp_filename, journal_filename)
@@ -0,0 +1,77 @@
+import os
+import shutil
+import logging
+import multiprocessing
+from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor
+
+# Get the maestro logger
+unzip_logger = logging.getLogger('maestro')
+
+# Members of the zip worth extracting: regular files with a known extension
+# Directories, dotfiles and paths escaping dest_dir are skipped
+def select_members(myzip, extensions):
+    members = []
+    for file_info in myzip.infolist():
+        if file_info.is_dir():
+            continue
+        name = file_info.filename
+        if os.path.isabs(name) or '..' in name.split('/'):
+            unzip_logger.warning("Skipping zip member outside the destination: " + name)
+            continue
+        if os.path.basename(name).startswith('.'):
+            continue
+        path, ext = os.path.splitext(name)
+        if ext not in extensions:
+            continue
+        members.append(file_info)
+    return members
+
+# Extract names from zip_filename into dest_dir
+# Runs in the worker processes, each one opens the zip on its own
+def extract_members(zip_filename, dest_dir, names, chunk_size):
+    with ZipFile(zip_filename) as myzip:
+        for name in names:
+            full_filename = os.path.join(dest_dir, name)
+            directory, filename = os.path.split(full_filename)
+            os.makedirs(directory, exist_ok=True)
+            # Extract aside and rename, a partial file never looks complete
+            part_filename = os.path.join(directory, '.' + filename + '.part')
+            with myzip.open(name) as f_in, open(part_filename, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out, chunk_size)
+            os.replace(part_filename, full_filename)
+    return names
+
+# Extract the members of zip_filename with a known extension into dest_dir
+# Members are spread over a pool of processes, so decompression uses several
+# cores. Small archives are extracted in this process, a pool costs more than it saves
+# Returns the extracted member names, in archive order
+def extract_zip(zip_filename, dest_dir, extensions, workers=4,
+                min_parallel_size=64 * 1024 * 1024, chunk_size=1024 * 1024):
+    with ZipFile(zip_filename) as myzip:
+        members = select_members(myzip, extensions)
+    names = [file_info.filename for file_info in members]
+    workers = min(workers, os.cpu_count() or 1)
+    total = sum(file_info.file_size for file_info in members)
+    if workers <= 1 or len(members) <= 1 or total < min_parallel_size:
+        return extract_members(zip_filename, dest_dir, names, chunk_size)
+
+    # Balance the groups by size, biggest members first
+    groups = [[] for i in range(min(workers * 4, len(members)))]
+    sizes = [0] * len(groups)
+    for file_info in sorted(members, key=lambda file_info: file_info.file_size, reverse=True):
+        smallest = sizes.index(min(sizes))
+        groups[smallest].append(file_info.filename)
+        sizes[smallest] += file_info.file_size
+    # fork, spawn would import the server module again in every worker and
+    # run its startup (FileSet build, sweepers, extractor scheduler). The
+    # workers only run extract_members (zipfile and os) and leave with
+    # os._exit, so the DuckDB and server threads copied along are never used
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=min(workers, len(groups)), mp_context=context) as executor:
+        futures = [executor.submit(extract_members, zip_filename, dest_dir, group, chunk_size)
+                   for group in groups]
+        for future in futures:
+            future.result()
+    unzip_logger.debug("zip extracted: " + zip_filename + " members: " + str(len(names)))
+    return names
@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import hashlib
+import threading
+import logging
+from contextlib import contextmanager
+
+# Get the maestro logger
+upload_logger = logging.getLogger('maestro')
+
+class UploadError(Exception):
+    pass
+
+# One resumable upload
+# Chunks are written at their offset into a temporary file. The state is kept
+# next to it, so an upload can be resumed after a restart of the server, and
+# continued on any server process
+class UploadSession:
+    def __init__(self, tmp_dir, upload_id, meta, size=None, sha256=None, received=0):
+        self.upload_id = upload_id
+        self.meta = meta
+        self.size = size
+        self.sha256 = sha256
+        # Bytes received without gaps from the start of the file
+        self.received = received
+        self.part_filename = os.path.join(tmp_dir, upload_id + '.part')
+        self.state_filename = os.path.join(tmp_dir, upload_id + '.json')
+        self.lock_filename = os.path.join(tmp_dir, upload_id + '.lock')
+
+    def save(self):
+        state = {"upload_id" : self.upload_id,
+                 "meta" : self.meta,
+                 "size" : self.size,
+                 "sha256" : self.sha256,
+                 "received" : self.received}
+        tmp_filename = self.state_filename + '.tmp'
+        with open(tmp_filename, 'w') as f_out:
+            json.dump(state, f_out)
+        os.replace(tmp_filename, self.state_filename)
+
+    # Read the state back, another process may have moved it on
+    # Returns False when the upload is gone (completed or aborted)
+    def load(self):
+        try:
+            with open(self.state_filename) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self.meta = state['meta']
+        self.size = state['size']
+        self.sha256 = state['sha256']
+        self.received = state['received']
+        # Trust the file, not the state, for what reached the disk
+        try:
+            self.received = min(self.received, os.path.getsize(self.part_filename))
+        except OSError:
+            return False
+        return True
+
+    # Exclusive access to the upload, across threads and server processes
+    # (flock on a file of its own). The state is loaded again once locked
+    @contextmanager
+    def locked(self):
+        with open(self.lock_filename, 'a') as f_lock:
+            fcntl.flock(f_lock.fileno(), fcntl.LOCK_EX)
+            if not self.load():
+                # Opening it brought the lock file back
+                if os.path.exists(self.lock_filename):
+                    os.remove(self.lock_filename)
+                raise UploadError("Couldn't find upload: " + self.upload_id)
+            yield self
+
+    def info(self):
+        return {"upload_id" : self.upload_id,
+                "offset" : self.received,
+                "size" : self.size}
+
+# Sessions live in tmp_dir only, nothing is kept in memory: with several
+# server processes any of them can get the next request of an upload
+class UploadStore:
+    def __init__(self, tmp_dir):
+        self.tmp_dir = tmp_dir
+
+    def create(self, meta, size=None, sha256=None):
+        session = UploadSession(self.tmp_dir, str(uuid.uuid4()), meta, size, sha256)
+        open(session.part_filename, 'wb').close()
+        session.save()
+        upload_logger.debug("upload session created: " + session.upload_id)
+        return session
+
+    # The session, as in its state file
+    def get(self, upload_id):
+        # upload_id is used in a file name, only accept our own ids
+        try:
+            uuid.UUID(upload_id)
+        except ValueError:
+            return None
+        session = UploadSession(self.tmp_dir, upload_id, None)
+        if not session.load():
+            return None
+        return session
+
+    # Write the chunk read from stream at offset
+    # offset may go back (a chunk sent again) but can't leave a gap
+    # Returns the offset the next chunk should start at
+    def write(self, session, offset, stream, chunk_size):
+        with session.locked():
+            if offset > session.received:
+                raise UploadError("Offset " + str(offset) + " beyond the bytes received: " + str(session.received))
+            fd = os.open(session.part_filename, os.O_WRONLY)
+            try:
+                position = offset
+                while True:
+                    data = stream.read(chunk_size)
+                    if not data:
+                        break
+                    # Checked before writing, the part file never grows past size
+                    if session.size != None and position + len(data) > session.size:
+                        raise UploadError("Upload larger than its size: " + str(session.size))
+                    os.pwrite(fd, data, position)
+                    position += len(data)
+            except Exception:
+                # Drop what a failed chunk wrote past the bytes received
+                if os.fstat(fd).st_size > session.received:
+                    os.ftruncate(fd, session.received)
+                raise
+            finally:
+                os.close(fd)
+            session.received = max(session.received, position)
+            session.save()
+            return session.received
+
+    # Check the file and move it to full_filename
+    def complete(self, session, full_filename, sha256=None):
+        with session.locked():
+            sha256 = sha256 or session.sha256
+            size = os.path.getsize(session.part_filename)
+            if session.size != None and size != session.size:
+                raise UploadError("Upload incomplete: " + str(size) + " of " + str(session.size) + " bytes")
+            if sha256:
+                digest = hashlib.sha256()
+                with open(session.part_filename, 'rb') as f:
+                    for data in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(data)
+                if digest.hexdigest() != sha256.lower():
+                    raise UploadError("Checksum mismatch: " + digest.hexdigest())
+            os.replace(session.part_filename, full_filename)
+            self.__forget(session)
+        upload_logger.debug("upload complete: " + session.upload_id + " to: " + full_filename)
+
+    def abort(self, session):
+        try:
+            with session.locked():
+                if os.path.exists(session.part_filename):
+                    os.remove(session.part_filename)
+                self.__forget(session)
+        except UploadError:
+            # Gone already
+            pass
+
+    # Drop uploads untouched for more than ttl seconds
+    def sweep(self, ttl):
+        now = time.time()
+        for filename in os.listdir(self.tmp_dir):
+            upload_id, ext = os.path.splitext(filename)
+            if ext != '.json':
+                continue
+            try:
+                if now - os.path.getmtime(os.path.join(self.tmp_dir, filename)) <= ttl:
+                    continue
+            except OSError:
+                continue
+            session = self.get(upload_id)
+            if session != None:
+                self.abort(session)
+                upload_logger.debug("upload session expired: " + upload_id)
+
+    def start_sweeper(self, ttl):
+        def sweeper():
+            while True:
+                time.sleep(ttl)
+                self.sweep(ttl)
+        thread = threading.Thread(target=sweeper, name='upload-sweeper', daemon=True)
+        thread.start()
+        return thread
+
+    # The lock file goes last, whoever waits on it finds no state and gives up
+    def __forget(self, session):
+        for filename in [session.state_filename, session.lock_filename]:
+            if os.path.exists(filename):
+                os.remove(filename)